@@ -5,12 +5,15 @@ from typing import List
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import minmax_scale
 from camera.sam import Sam_Detector, vis_mask_image
+from camera.dino import get_dino_model, release_dino_models, token_cache_key, get_cached_tokens, set_cached_tokens, \
+    clear_cached_tokens, get_default_device, get_dino_device, dino_autocast, set_dino_threads, get_dino_onnx_model
 import torch
 import open3d as o3d
 import yaml
 import json
 from scipy.spatial.transform import Rotation
 import os
+import time
 import skimage
 
 CAM = {
@@ -21,44 +24,312 @@ CAM = {
 }
 CAM_INDEX = [CAM['cam0'], CAM['cam1'], CAM['cam2'], CAM['cam3']]
 
-def get_dino_features(img_raw:np.ndarray, scale:int=3)->torch.Tensor:
+def get_dino_features(img_raw:np.ndarray, scale:int=3, **kwargs)->torch.Tensor:
     """get dino features for only one img
 
     Args:
         img (np.ndarray): (h, w, 3)
         scale (int, optional): _description_. Defaults to 3.
+        kwargs: the options of get_dino_features_batch, e.g. device and precision
 
     Returns:
         torch.Tensor: (h, w, F)
     """
-    img_raw = img_raw.astype('float32') / 255.
-    img_raw = skimage.img_as_float32(img_raw)
-    if os.path.isdir('./thirdparty_module/dinov2'):
-        torch.hub.set_dir( "./")
-        model = torch.hub.load('./thirdparty_module/dinov2', 'dinov2_vitb14', source='local', pretrained=False).cuda()
-        model.load_state_dict(torch.load('./thirdparty_module/dinov2_vitb14_pretrain.pth'))
-    else:
-        torch.hub.set_dir("../")
-        model = torch.hub.load('../thirdparty_module/dinov2', 'dinov2_vitb14', source='local', pretrained=False).cuda()
-        model.load_state_dict(torch.load('../thirdparty_module/dinov2_vitb14_pretrain.pth'))
-    h, w = img_raw.shape[0] // 14 * 14,  img_raw.shape[1] // 14 * 14
-    img = skimage.transform.resize(
-                img_raw,
-                (img_raw.shape[0] // 14 * 14 , img_raw.shape[1] // 14 * 14 )
-            ).astype('float32')
-    img = torch.from_numpy(img)
-    img = img[None, :].cuda()
-    # print('Picture for Dino size:', img.shape)
+    return get_dino_features_batch([img_raw], scale=scale, **kwargs)[0]
+
+def forward_patch_tokens(model:torch.nn.Module, img:torch.Tensor)->torch.Tensor:
+    """the patch tokens of a batch of imgs as feature maps
+
+    Args:
+        img (torch.Tensor): (B, 3, h, w), h and w are multiples of 14
+
+    Returns:
+        torch.Tensor: (B, F, h // 14, w // 14)
+    """
     with torch.no_grad():
-        ### (batch size, 3, height, width)
-        ret = model.forward_features(img.permute(0, 3, 1, 2))
+        ret = model.forward_features(img)
     features = ret['x_norm_patchtokens']
-    N, _, F = features.shape
-    ### (height, width, features) torch.Tensor np.float32
-    features = features.reshape(img.shape[1] // 14, img.shape[2] // 14, F).permute(2, 0, 1)
-    features = torch.nn.functional.interpolate(features.unsqueeze(0), size=(img_raw.shape[0] // scale , img_raw.shape[1] // scale ), mode='bilinear', align_corners=False)
-    features = features.squeeze(0).permute(1, 2, 0)
-    return features
+    B, _, F = features.shape
+    return features.reshape(B, img.shape[2] // 14, img.shape[3] // 14, F).permute(0, 3, 1, 2)
+
+def get_tile_starts(length:int, tile:int, stride:int)->list:
+    """the offsets of the tiles covering [0, length), the last tile ends at length"""
+    if length <= tile:
+        return [0]
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+def forward_patch_tokens_tiled(model:torch.nn.Module, img:torch.Tensor, tile_size:int=518, overlap:int=56, max_batch:int=8)->torch.Tensor:
+    """forward_patch_tokens of one img by overlapping tiles, the peak memory only depends on the tile size
+
+    Inside the overlaps the tiles are blended with weights ramping up from the tile borders.
+
+    Args:
+        img (torch.Tensor): (1, 3, h, w), h and w are multiples of 14
+        tile_size (int, optional): multiple of 14 (pixels). Defaults to 518.
+        overlap (int, optional): multiple of 14 (pixels), smaller than tile_size. Defaults to 56.
+        max_batch (int, optional): tiles per forward pass. Defaults to 8.
+
+    Returns:
+        torch.Tensor: (1, F, h // 14, w // 14)
+    """
+    assert tile_size % 14 == 0 and overlap % 14 == 0 and overlap < tile_size, 'tiles must be aligned to the patches'
+    _, _, h, w = img.shape
+    th, tw = min(tile_size, h), min(tile_size, w)
+    boxes = [(y, x) for y in get_tile_starts(h, th, tile_size - overlap) for x in get_tile_starts(w, tw, tile_size - overlap)]
+
+    def window(n):
+        index = torch.arange(n, dtype=torch.float32, device=img.device)
+        return torch.clamp(torch.minimum(index + 1, n - index) / (overlap // 14 + 1), max=1)
+    ### (th // 14, tw // 14)
+    weight = window(th // 14)[:, None] * window(tw // 14)[None, :]
+
+    numerator, denominator = 0, torch.zeros((h // 14, w // 14), device=img.device)
+    for i in range(0, len(boxes), max_batch):
+        batch = boxes[i:i + max_batch]
+        tokens = forward_patch_tokens(model, torch.cat([img[:, :, y:y + th, x:x + tw] for y, x in batch], dim=0))
+        if isinstance(numerator, int):
+            numerator = torch.zeros((tokens.shape[1], h // 14, w // 14), device=img.device)
+        for (y, x), token in zip(batch, tokens):
+            numerator[:, y // 14:(y + th) // 14, x // 14:(x + tw) // 14] += token * weight
+            denominator[y // 14:(y + th) // 14, x // 14:(x + tw) // 14] += weight
+    return (numerator / denominator)[None]
+
+def forward_patch_tokens_sparse(model:torch.nn.Module, img:torch.Tensor, patch_mask:torch.Tensor, border:int=1)->torch.Tensor:
+    """forward_patch_tokens of one img with only the patch tokens near the mask, the others are dropped before the blocks
+
+    Args:
+        img (torch.Tensor): (1, 3, h, w), h and w are multiples of 14
+        patch_mask (torch.Tensor): (h // 14, w // 14) bool, the patches covering the object
+        border (int, optional): rings of patches kept around the mask as context, at least 1 so the bilinear
+            upsampling of the tokens is exact inside the mask. Defaults to 1.
+
+    Returns:
+        torch.Tensor: (1, F, h // 14, w // 14), zero at the dropped patches
+    """
+    assert border >= 1, 'the upsampling inside the mask needs the neighbouring patches'
+    keep = torch.nn.functional.max_pool2d(patch_mask[None, None].float(), kernel_size=2 * border + 1, stride=1, padding=border)
+    keep = keep.reshape(-1) > 0
+    with torch.no_grad():
+        x = model.prepare_tokens_with_masks(img)
+        ### the class (and register) tokens go first
+        num_prefix = x.shape[1] - keep.shape[0]
+        x = torch.cat([x[:, :num_prefix], x[:, num_prefix:][:, keep]], dim=1)
+        for blk in model.blocks:
+            x = blk(x)
+        x = model.norm(x)[0, num_prefix:]
+    features = torch.zeros((keep.shape[0], x.shape[-1]), dtype=x.dtype, device=x.device)
+    features[keep] = x
+    return features.reshape(1, img.shape[2] // 14, img.shape[3] // 14, -1).permute(0, 3, 1, 2)
+
+def get_dino_features_batch(imgs_raw:List[np.ndarray], scale:int=3, bucket:int=14, max_batch:int=8,
+                            cache_dir:str=None, tile_size:int=None, tile_overlap:int=56, native:bool=False,
+                            masks:List[np.ndarray]=None, sparse_border:int=None, device=None, precision:str='fp32',
+                            num_threads:int=None, backend:str='torch', onnx_cache_dir:str='./thirdparty_module/onnx',
+                            preprocess:str='torch', token_cache_size:int=16)->List[torch.Tensor]:
+    """get dino features for many imgs at once, e.g. the crops of all the cameras of one or several scenes
+
+    Every img is resized to a multiple of `bucket` (rounded down as for a single img), the imgs of the same size
+    go through the backbone together, in batches of at most `max_batch`. A `bucket` larger than 14 puts
+    more imgs into the same size at the cost of a slightly different resize.
+    The patch tokens of the recent imgs are kept in memory (and on disk with `cache_dir`) independently of the scale,
+    so asking for another scale of an img does not run the backbone again.
+
+    Args:
+        imgs_raw (List[np.ndarray]): (h_i, w_i, 3) uint8
+        scale (int, optional): the features are (h_i // scale, w_i // scale). Defaults to 3.
+        bucket (int, optional): a multiple of the patch size 14. Defaults to 14.
+        max_batch (int, optional): Defaults to 8.
+        cache_dir (str, optional): the patch tokens of every img are looked up in (and added to) this on-disk cache,
+            stored in float16 (the returned tokens are rounded the same way). Defaults to None(no disk cache).
+        tile_size (int, optional): the resized imgs larger than this (pixels, a multiple of 14) go through the backbone
+            by overlapping tiles, see forward_patch_tokens_tiled. Defaults to None(whole imgs).
+        tile_overlap (int, optional): (pixels, a multiple of 14). Defaults to 56.
+        native (bool, optional): return the patch tokens without upsampling them, (h'_i // 14, w'_i // 14, F)
+            for the resized (h'_i, w'_i), see sample_patch_tokens. Defaults to False.
+        masks (List[np.ndarray], optional): (h_i, w_i) the object masks of the imgs, used by sparse_border. Defaults to None.
+        sparse_border (int, optional): only run the patches within this many patches of the mask through the blocks,
+            see forward_patch_tokens_sparse, the features are only valid near the masks. Defaults to None(all the patches).
+        device (optional): Defaults to None(cuda if available, else cpu, cpu for int8).
+        precision (str, optional): 'fp32', 'bf16' or 'int8' (cpu), see camera.dino.get_dino_model. Defaults to 'fp32'.
+        num_threads (int, optional): the cpu threads of torch (and of ONNX Runtime). Defaults to None(unchanged).
+        backend (str, optional): 'torch' or 'onnx' (ONNX Runtime on cpu, fp32, see camera.dino.OnnxDino). Defaults to 'torch'.
+        onnx_cache_dir (str, optional): the exported graphs of the 'onnx' backend. Defaults to './thirdparty_module/onnx'.
+        preprocess (str, optional): 'torch' (see preprocess_dino_imgs) or 'skimage' (the float64 resize on cpu of the
+            first fields). Defaults to 'torch'.
+        token_cache_size (int, optional): the patch tokens of this many recent imgs are kept in cpu memory. Defaults to 16.
+
+    Returns:
+        List[torch.Tensor]: (h_i // scale, w_i // scale, F)
+    """
+    assert bucket % 14 == 0, 'the bucket must be a multiple of the patch size 14'
+    sparse = sparse_border is not None and masks is not None
+    device = get_dino_device(device, precision)
+    set_dino_threads(num_threads)
+    options = {'bucket': bucket, 'tile_size': tile_size, 'tile_overlap': tile_overlap, 'preprocess': preprocess}
+    if precision != 'fp32':
+        options['precision'] = precision
+    if backend != 'torch':
+        options['backend'] = backend
+    keys = []
+    for idx, img_raw in enumerate(imgs_raw):
+        if sparse:
+            options = dict(options, sparse_border=sparse_border, mask=token_cache_key(np.asarray(masks[idx], dtype=bool)))
+        keys.append(token_cache_key(img_raw, options))
+    tokens_ls = [get_cached_tokens(key, cache_dir, device=device, cache_size=token_cache_size) for key in keys]
+
+    buckets = {}
+    for idx, img_raw in enumerate(imgs_raw):
+        if tokens_ls[idx] is not None:
+            continue
+        size = (max(1, img_raw.shape[0] // bucket) * bucket, max(1, img_raw.shape[1] // bucket) * bucket)
+        buckets.setdefault(size, []).append(idx)
+
+    ### loaded once per process, see camera.dino.release_dino_models
+    if not buckets:
+        model = None
+    elif backend == 'torch':
+        model = get_dino_model(device, precision=precision)
+    elif backend == 'onnx':
+        if sparse or precision != 'fp32':
+            raise NotImplementedError('the onnx backend runs every patch in fp32')
+        model = get_dino_onnx_model(onnx_cache_dir, num_threads=num_threads)
+    else:
+        raise NotImplementedError
+    for (h, w), indices in buckets.items():
+        for i in range(0, len(indices), max_batch):
+            batch = indices[i:i + max_batch]
+            ### (batch size, 3, height, width)
+            if preprocess == 'torch':
+                img = preprocess_dino_imgs([imgs_raw[idx] for idx in batch], (h, w), device)
+            elif preprocess == 'skimage':
+                imgs = []
+                for idx in batch:
+                    img_raw = imgs_raw[idx].astype('float32') / 255.
+                    img_raw = skimage.img_as_float32(img_raw)
+                    imgs.append(skimage.transform.resize(img_raw, (h, w)).astype('float32'))
+                img = torch.from_numpy(np.stack(imgs, axis=0)).to(device).permute(0, 3, 1, 2)
+            else:
+                raise NotImplementedError
+            ### (batch size, features, height // 14, width // 14)
+            with dino_autocast(device, precision):
+                if sparse:
+                    ### the patches touched by the mask resized with the img
+                    patch_masks = [torch.nn.functional.max_pool2d(torch.nn.functional.interpolate(
+                        torch.from_numpy(np.asarray(masks[idx], dtype='float32'))[None, None], size=(h, w), mode='nearest'),
+                        kernel_size=14)[0, 0].to(img.device) > 0 for idx in batch]
+                    features = torch.cat([forward_patch_tokens_sparse(model, img[j:j + 1], patch_masks[j], border=sparse_border)
+                                          for j in range(img.shape[0])], dim=0)
+                elif tile_size and max(h, w) > tile_size:
+                    features = torch.cat([forward_patch_tokens_tiled(model, img[j:j + 1], tile_size=tile_size, overlap=tile_overlap,
+                                                                     max_batch=max_batch) for j in range(img.shape[0])], dim=0)
+                else:
+                    features = forward_patch_tokens(model, img)
+            features = features.to(torch.float32)
+            for j, idx in enumerate(batch):
+                tokens_ls[idx] = set_cached_tokens(keys[idx], features[j].permute(1, 2, 0), cache_dir, token_cache_size)
+
+    if native:
+        return tokens_ls
+    return [upsample_patch_tokens(tokens, (img_raw.shape[0] // scale, img_raw.shape[1] // scale))
+            for tokens, img_raw in zip(tokens_ls, imgs_raw)]
+
+def preprocess_dino_imgs(imgs_raw:List[np.ndarray], size:tuple, device='cuda')->torch.Tensor:
+    """the uint8 imgs are moved to the device as they are, then converted and resized there
+
+    The anti-aliased bilinear resize stands for the one of skimage.transform.resize, without the float64 copies on cpu.
+
+    Args:
+        imgs_raw (List[np.ndarray]): (h_i, w_i, 3) uint8
+        size (tuple): (h, w)
+
+    Returns:
+        torch.Tensor: (B, 3, h, w) float32 in [0, 1]
+    """
+    imgs = []
+    for img_raw in imgs_raw:
+        img = torch.from_numpy(np.ascontiguousarray(img_raw)).to(device, non_blocking=True).permute(2, 0, 1)[None]
+        img = img.to(torch.float32) / 255.
+        if tuple(img.shape[2:]) != tuple(size):
+            img = torch.nn.functional.interpolate(img, size=size, mode='bilinear', align_corners=False, antialias=True)
+        imgs.append(img)
+    return torch.cat(imgs, dim=0)
+
+def upsample_patch_tokens(tokens:torch.Tensor, size:tuple)->torch.Tensor:
+    """(H, W, F) patch tokens -> (h, w, F) bilinearly resized features"""
+    return torch.nn.functional.interpolate(tokens.permute(2, 0, 1)[None], size=size, mode='bilinear',
+                                           align_corners=False).squeeze(0).permute(1, 2, 0)
+
+def get_dino_features_pyramid(imgs_raw:List[np.ndarray], scales:list=[3, 6, 14], **kwargs)->List[dict]:
+    """the features of every img at several scales, from a single backbone pass
+
+    Args:
+        imgs_raw (List[np.ndarray]): (h_i, w_i, 3) uint8
+        scales (list, optional): Defaults to [3, 6, 14].
+        kwargs: the options of get_dino_features_batch
+
+    Returns:
+        List[dict]: {scale: (h_i // scale, w_i // scale, F)} for every img
+    """
+    tokens_ls = get_dino_features_batch(imgs_raw, native=True, **kwargs)
+    return [{scale: upsample_patch_tokens(tokens, (img_raw.shape[0] // scale, img_raw.shape[1] // scale)) for scale in scales}
+            for tokens, img_raw in zip(tokens_ls, imgs_raw)]
+
+def compare_dino_precisions(imgs_raw:List[np.ndarray], precisions:list=['bf16', 'int8'], device='cpu', **kwargs)->List[dict]:
+    """the latency and the accuracy of reduced precisions of the backbone against the fp32 reference, img by img
+
+    Args:
+        imgs_raw (List[np.ndarray]): (h_i, w_i, 3) uint8
+        precisions (list, optional): see get_dino_features_batch. Defaults to ['bf16', 'int8'].
+        device (optional): Defaults to 'cpu'.
+        kwargs: the other options of get_dino_features_batch, the disk cache is not used
+
+    Returns:
+        List[dict]: {precision: {'latency': seconds, 'cosine': mean cosine similarity of the patch tokens to fp32,
+            'max_error': max absolute difference to fp32}} for every img, fp32 included
+    """
+    kwargs = dict(kwargs, cache_dir=None, native=True, device=device)
+    results = [{} for _ in imgs_raw]
+    references = []
+    for precision in ['fp32'] + [p for p in precisions if p != 'fp32']:
+        ### load the model and warm up before timing
+        get_dino_features_batch(imgs_raw[:1], precision=precision, **kwargs)
+        for idx, img_raw in enumerate(imgs_raw):
+            clear_cached_tokens()
+            start = time.perf_counter()
+            tokens = get_dino_features_batch([img_raw], precision=precision, **kwargs)[0]
+            latency = time.perf_counter() - start
+            if precision == 'fp32':
+                references.append(tokens)
+            reference = references[idx]
+            results[idx][precision] = {
+                'latency': latency,
+                'cosine': torch.nn.functional.cosine_similarity(tokens, reference, dim=-1).mean().item(),
+                'max_error': (tokens - reference).abs().max().item()}
+    clear_cached_tokens()
+    return results
+
+def sample_patch_tokens(tokens:torch.Tensor, rows:np.ndarray, cols:np.ndarray, size:tuple)->torch.Tensor:
+    """sample the patch tokens only at some pixels of a (h, w) grid over the img
+
+    The result equals indexing the bilinear upsampling of the tokens to (h, w) done by get_dino_features,
+    without building the (h, w, F) map.
+
+    Args:
+        tokens (torch.Tensor): (H, W, F) patch tokens (get_dino_features_batch(native=True))
+        rows (np.ndarray): (n, ) pixel rows in [0, h)
+        cols (np.ndarray): (n, ) pixel columns in [0, w)
+        size (tuple): (h, w)
+
+    Returns:
+        torch.Tensor: (n, F)
+    """
+    h, w = size
+    ### the centers of the pixels in normalized coordinates, with align_corners=False as the upsampling
+    grid = torch.stack([torch.from_numpy((2 * cols + 1) / w - 1), torch.from_numpy((2 * rows + 1) / h - 1)], dim=-1)
+    grid = grid.to(tokens.device).to(tokens.dtype)[None, None]
+    features = torch.nn.functional.grid_sample(tokens.permute(2, 0, 1)[None], grid, mode='bilinear', padding_mode='border',
+                                               align_corners=False)
+    return features[0, :, 0].T
 
 def depth2pt_K_numpy(depths:np.ndarray, K:np.ndarray , R:np.ndarray, xyz_images=True)->np.ndarray:
     """
@@ -283,7 +554,8 @@ def line_dist(points:torch.tensor, line:torch.tensor)->torch.tensor:
         dist = np.matmul(points, line[:-1].reshape(3, 1)) + line[-1]
         return dist.squeeze()
 
-def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, name = 'mm', prune_method='sam', key:int=0, verbose:bool=True, samckp_path:str='./thirdparty_module/sam_vit_h_4b8939.pth')->(np.ndarray, np.ndarray, np.ndarray):
+def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, name = 'mm', prune_method='sam', key:int=0, verbose:bool=True, samckp_path:str='./thirdparty_module/sam_vit_h_4b8939.pth',
+             views:list=None, dino_conf:dict=None)->(np.ndarray, np.ndarray, np.ndarray):
     """
     the pipeline of the data loading/capturing then processing
 
@@ -296,6 +568,8 @@ def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, na
         extrinsics_path (str): path of the extrinsics (json path)
         downsample_size (tuple): the down_sampled size of each image
         scale: the shrink scale
+        views (list): indices of the cameras to process, None for all of them
+        dino_conf (dict): options of get_dino_features_batch, see the dino section of config.yaml
     Returns:
         points: (n, 3) torch.Tensor
         features: (n, F) torch.Tensor
@@ -319,13 +593,19 @@ def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, na
     colors_pile = colors[..., (2, 1, 0)]
     depths[depths < 0] = 0
     points_undistort = depth2pt_K_numpy(depths, intrinsics, np.linalg.inv(extrinsics), xyz_images=True)
-    detector = Sam_Detector(sam_checkpoint=samckp_path)
+    detector = Sam_Detector(sam_checkpoint=samckp_path, device=(dino_conf or {}).get('device') or get_default_device(),
+                            backend=(dino_conf or {}).get('backend', 'torch'),
+                            onnx_cache_dir=(dino_conf or {}).get('onnx_cache_dir', './thirdparty_module/onnx'),
+                            num_threads=(dino_conf or {}).get('num_threads'))
     points_ls = []
     features_ls = []
     batch_sign_ls = []
     colors_ls = []
+    crops = {}
     ### attention! the unit now is mm
     for idx in range(points_undistort.shape[0]):
+        if views is not None and idx not in views:
+            continue
         points = points_undistort[idx]
         colors = colors_pile[idx]
         depth = depths[idx]
@@ -381,11 +661,18 @@ def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, na
         prune_points = points[bb[1]:bb[3], bb[0]:bb[2]]
         pruned_mask = mask[bb[1]:bb[3], bb[0]:bb[2]].astype('float32')
         pruned_depth = depth[bb[1]:bb[3], bb[0]:bb[2]]
-
+        crops[idx] = (pruned_colors, prune_points, pruned_mask, pruned_depth)
+
+    dino_conf = dict(dino_conf or {})
+    ### keep the patch tokens and sample them at the masked pixels only, instead of upsampling dense maps
+    sample_points = dino_conf.pop('sample_points', False)
+    ### all the cameras go through the backbone together
+    features_all = get_dino_features_batch([crop[0] for crop in crops.values()], scale=scale, native=sample_points,
+                                           masks=[crop[2] > 0 for crop in crops.values()], **dino_conf)
+    for (idx, (pruned_colors, prune_points, pruned_mask, pruned_depth)), features in zip(crops.items(), features_all):
         h, w, _ = pruned_colors.shape
         h, w = h // scale, w // scale
 
-        features:torch.tensor = get_dino_features(pruned_colors, scale=scale)
         if save:
             cv2.imwrite(f'./data/dino_color{idx}.png', pruned_colors[..., (2, 1, 0)])
             np.save(f'./data/dino_features{idx}.npy', features.cpu().numpy())
@@ -398,7 +685,11 @@ def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, na
             print('Downsampled mask size:', downsampled_mask.shape)
             print('features size:', features.shape)
 
-        masked_features = features[torch.from_numpy(downsampled_mask)]
+        if sample_points:
+            rows, cols = np.nonzero(downsampled_mask)
+            masked_features = sample_patch_tokens(features, rows, cols, (h, w))
+        else:
+            masked_features = features[torch.from_numpy(downsampled_mask)]
         masked_points = downsampled_points[downsampled_mask]
         masked_colors = downsampled_colors[downsampled_mask]
         batch_sign = np.ones((masked_points.shape[0],)) * (idx + 1)
@@ -435,5 +726,3 @@ def pipeline(data_path:str, extrinsics_path:str, scale:int=3, save:bool=True, na
     colors = np.concatenate(colors_ls, axis=0)
 
     return points, features, colors, batch_sign, points_undistort.reshape(-1, 3) / 1000.
-
-
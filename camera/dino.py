@@ -0,0 +1,256 @@
+import os
+import json
+import math
+import contextlib
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import torch
+from camera.onnx_runtime import onnx_cache_path, export_onnx, get_onnx_session, run_onnx_session, release_onnx_sessions
+
+### the DINOv2 backbones of the process, {(device, checkpoint): model}
+_MODELS = {}
+### the patch tokens of the recent images on cpu, {key: (H, W, F) tensor}, least recently used first
+_TOKENS = OrderedDict()
+TOKEN_CACHE_SIZE = 16
+
+def find_dinov2_dir():
+    """the local dinov2 repository and the checkpoint, looked up from the repository root or one level below"""
+    for root in ['.', '..']:
+        if os.path.isdir(os.path.join(root, 'thirdparty_module/dinov2')):
+            return os.path.join(root, 'thirdparty_module/dinov2'), os.path.join(root, 'thirdparty_module/dinov2_vitb14_pretrain.pth')
+    return './thirdparty_module/dinov2', './thirdparty_module/dinov2_vitb14_pretrain.pth'
+
+def get_default_device()->str:
+    """'cuda' if there is a GPU, else 'cpu'"""
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def get_dino_device(device=None, precision:str='fp32')->torch.device:
+    """the device of the backbone, cpu for the int8 precision, else see get_default_device"""
+    if precision == 'int8':
+        if device is not None and torch.device(device).type != 'cpu':
+            raise ValueError(f'the dynamic int8 quantization only runs on cpu, not on {device}')
+        return torch.device('cpu')
+    return torch.device(device or get_default_device())
+
+def get_dino_model(device=None, checkpoint:str=None, precision:str='fp32')->torch.nn.Module:
+    """the DINOv2 ViT-B/14 on `device`, loaded on the first request and reused by all the later calls
+
+    Args:
+        device (optional): Defaults to None(see get_dino_device).
+        checkpoint (str, optional): the state dict. Defaults to None(./thirdparty_module/dinov2_vitb14_pretrain.pth).
+        precision (str, optional): 'fp32', 'bf16' (the same weights, see dino_autocast) or 'int8'
+            (dynamic int8 quantization of the linear layers, cpu only). Defaults to 'fp32'.
+
+    Returns:
+        torch.nn.Module: in eval mode
+    """
+    repo_dir, default_checkpoint = find_dinov2_dir()
+    checkpoint = checkpoint or default_checkpoint
+    device = get_dino_device(device, precision)
+    ### bf16 only changes the forward, it shares the fp32 weights
+    weights = 'int8' if precision == 'int8' else 'fp32'
+    key = (str(device), os.path.abspath(checkpoint), weights)
+    if key not in _MODELS:
+        torch.hub.set_dir(os.path.dirname(os.path.dirname(repo_dir)) or './')
+        model = torch.hub.load(repo_dir, 'dinov2_vitb14', source='local', pretrained=False)
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        model = model.eval()
+        if weights == 'int8':
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        _MODELS[key] = model.to(device)
+    return _MODELS[key]
+
+class OnnxDino:
+    """the DINOv2 ViT-B/14 run by ONNX Runtime on cpu, a drop-in for `model.forward_features(img)['x_norm_patchtokens']`
+
+    One graph of any batch and input size is exported and cached in `cache_dir`, the position embeddings are
+    interpolated to the input size outside of it (see interpolate_pos_embed) from the ones saved next to it.
+    After the first run no torch model is built nor checkpoint deserialized.
+    The sparse tokens of camera.forward_patch_tokens_sparse need the torch model.
+    """
+
+    def __init__(self, cache_dir:str, checkpoint:str=None, num_threads:int=None) -> None:
+        self.cache_dir = cache_dir
+        self.checkpoint = checkpoint
+        self.num_threads = num_threads
+        ### the position embeddings per input size, {(h, w): (1, 1 + h // 14 * w // 14, F)}
+        self.pos_embeds = {}
+
+    def export(self, path:str):
+        model = get_dino_model('cpu', self.checkpoint)
+        pos_embed = {'pos_embed': model.pos_embed.detach().numpy(), 'patch_size': model.patch_size,
+                     'offset': getattr(model, 'interpolate_offset', 0.1), 'antialias': getattr(model, 'interpolate_antialias', False)}
+        ### saved before the graph, a graph on disk always has its position embeddings
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **pos_embed)
+        os.replace(tmp_path, pos_embed_path(path))
+        size = 224
+        example = interpolate_pos_embed(model.pos_embed.detach(), size, size, model.patch_size, pos_embed['offset'], pos_embed['antialias'])
+        export_onnx(PatchTokens(model), (torch.zeros((1, 3, size, size)), example), path, ['img', 'pos_embed'], 'patch_tokens',
+                    dynamic_axes={'img': {0: 'batch', 2: 'height', 3: 'width'}, 'pos_embed': {1: 'tokens'},
+                                  'patch_tokens': {0: 'batch', 1: 'patches'}})
+
+    def forward_features(self, img:torch.Tensor)->dict:
+        """img (B, 3, h, w) -> {'x_norm_patchtokens': (B, h // 14 * w // 14, F)}"""
+        h, w = img.shape[2:]
+        path = onnx_cache_path(self.cache_dir, 'dinov2_vitb14', checkpoint_fingerprint(self.checkpoint))
+        if not os.path.isfile(path):
+            self.export(path)
+        if (h, w) not in self.pos_embeds:
+            data = np.load(pos_embed_path(path))
+            self.pos_embeds[(h, w)] = interpolate_pos_embed(torch.from_numpy(data['pos_embed']), h, w, int(data['patch_size']),
+                                                            float(data['offset']), bool(data['antialias']))
+        return {'x_norm_patchtokens': run_onnx_session(get_onnx_session(path, self.num_threads), img, self.pos_embeds[(h, w)])}
+
+def pos_embed_path(path:str)->str:
+    """the position embeddings saved next to an exported DINOv2 graph"""
+    return os.path.splitext(path)[0] + '_pos_embed.npz'
+
+def interpolate_pos_embed(pos_embed:torch.Tensor, h:int, w:int, patch_size:int=14, offset:float=0.1,
+                          antialias:bool=False)->torch.Tensor:
+    """the position embeddings of a DINOv2 backbone for an (h, w) input, as its interpolate_pos_encoding
+
+    Args:
+        pos_embed (torch.Tensor): (1, 1 + M * M, F) the class token and the M x M grid of the pretraining
+
+    Returns:
+        torch.Tensor: (1, 1 + h // patch_size * w // patch_size, F)
+    """
+    num_patches = pos_embed.shape[1] - 1
+    h0, w0 = h // patch_size, w // patch_size
+    if h0 * w0 == num_patches and h == w:
+        return pos_embed
+    pos_embed = pos_embed.float()
+    dim, M = pos_embed.shape[-1], int(math.sqrt(num_patches))
+    if offset:
+        kwargs = {'scale_factor': (float(h0 + offset) / M, float(w0 + offset) / M)}
+    else:
+        kwargs = {'size': (h0, w0)}
+    patch_pos_embed = torch.nn.functional.interpolate(pos_embed[:, 1:].reshape(1, M, M, dim).permute(0, 3, 1, 2), mode='bicubic',
+                                                      antialias=antialias, **kwargs)
+    patch_pos_embed = patch_pos_embed.permute(0, 2, 3, 1).reshape(1, -1, dim)
+    return torch.cat((pos_embed[:, :1], patch_pos_embed), dim=1)
+
+class PatchTokens(torch.nn.Module):
+    """the normalized patch tokens of a DINOv2 backbone as the only output, for the export,
+    the position embeddings of the input size are an input (see interpolate_pos_embed)"""
+
+    def __init__(self, model:torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, img:torch.Tensor, pos_embed:torch.Tensor)->torch.Tensor:
+        x = self.model.patch_embed(img)
+        x = torch.cat((self.model.cls_token.expand(x.shape[0], -1, -1), x), dim=1) + pos_embed
+        for block in self.model.blocks:
+            x = block(x)
+        return self.model.norm(x)[:, 1:]
+
+def get_dino_onnx_model(cache_dir:str='./thirdparty_module/onnx', checkpoint:str=None, num_threads:int=None)->OnnxDino:
+    """the ONNX Runtime counterpart of get_dino_model, see OnnxDino"""
+    checkpoint = checkpoint or find_dinov2_dir()[1]
+    key = ('onnx', os.path.abspath(checkpoint), os.path.abspath(cache_dir))
+    if key not in _MODELS:
+        _MODELS[key] = OnnxDino(cache_dir, checkpoint, num_threads)
+    return _MODELS[key]
+
+def dino_autocast(device=None, precision:str='fp32'):
+    """the context of the forward of the backbone, bf16 autocast if asked for and supported by the device"""
+    device = torch.device(device or get_default_device())
+    if precision == 'bf16' and (device.type == 'cpu' or torch.cuda.is_bf16_supported()):
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def set_dino_threads(num_threads:int=None):
+    """the number of cpu threads of torch, left unchanged if None"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+def release_dino_models(device=None):
+    """drop the cached backbones (of one device, or all of them) and the patch tokens in memory, and return their memory
+
+    Args:
+        device (optional): Defaults to None(all devices).
+    """
+    for key in list(_MODELS.keys()):
+        if device is None or key[0] == str(torch.device(device)):
+            del _MODELS[key]
+    if device is None:
+        release_onnx_sessions()
+    clear_cached_tokens()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def checkpoint_fingerprint(checkpoint:str=None)->str:
+    """sha1 of the path, the size and the modification time of a checkpoint, it changes whenever the file is replaced
+
+    The content is not read, hashing a checkpoint of GBs costs about as much as loading it.
+    """
+    checkpoint = os.path.abspath(checkpoint or find_dinov2_dir()[1])
+    stat = os.stat(checkpoint)
+    return hashlib.sha1(json.dumps([checkpoint, stat.st_size, stat.st_mtime_ns]).encode('utf-8')).hexdigest()
+
+def token_cache_key(img:np.ndarray, options:dict=None)->str:
+    """the key of the patch tokens of an image, a sha1 of the image bytes and of the options changing the tokens
+
+    Args:
+        img (np.ndarray): (h, w, 3) uint8
+        options (dict, optional): json serializable. Defaults to None.
+    """
+    sha = hashlib.sha1()
+    img = np.ascontiguousarray(img)
+    sha.update(json.dumps({'shape': img.shape, 'dtype': img.dtype.str, 'options': options or {}}, sort_keys=True).encode('utf-8'))
+    sha.update(img.tobytes())
+    return sha.hexdigest()
+
+def token_cache_path(cache_dir:str, key:str, checkpoint:str=None)->str:
+    """the entry of the on-disk token cache, the key is combined with the checkpoint, see checkpoint_fingerprint"""
+    sha = hashlib.sha1()
+    sha.update(key.encode('utf-8'))
+    sha.update(checkpoint_fingerprint(checkpoint).encode('utf-8'))
+    return os.path.join(cache_dir, sha.hexdigest() + '.npy')
+
+def clear_cached_tokens():
+    """drop the patch tokens in memory, the disk cache is kept"""
+    _TOKENS.clear()
+
+def get_cached_tokens(key:str, cache_dir:str=None, device='cuda', cache_size:int=TOKEN_CACHE_SIZE)->torch.Tensor:
+    """(H, W, F) float32 patch tokens on `device` from the memory cache, then the disk cache, None if there are none"""
+    if key in _TOKENS:
+        _TOKENS.move_to_end(key)
+        return _TOKENS[key].to(device)
+    if cache_dir:
+        path = token_cache_path(cache_dir, key)
+        if os.path.isfile(path):
+            tokens = torch.from_numpy(np.load(path)).to(device).to(torch.float32)
+            set_cached_tokens(key, tokens, cache_size=cache_size)
+            return tokens
+    return None
+
+def set_cached_tokens(key:str, tokens:torch.Tensor, cache_dir:str=None, cache_size:int=TOKEN_CACHE_SIZE)->torch.Tensor:
+    """keep a cpu copy of the patch tokens in the memory cache (of the `cache_size` most recent images, 0 for none),
+    and store them in float16 in the disk cache if cache_dir is given
+
+    Returns:
+        torch.Tensor: the tokens as they are cached, rounded to float16 with cache_dir, so a hit of either cache
+            returns the same tokens as the run that filled it
+    """
+    if cache_dir:
+        tokens = tokens.to(torch.float16).to(torch.float32)
+    if cache_size > 0:
+        ### the device memory is left to the optimization
+        _TOKENS[key] = tokens.cpu()
+        _TOKENS.move_to_end(key)
+    while len(_TOKENS) > cache_size:
+        _TOKENS.popitem(last=False)
+    if cache_dir:
+        path = token_cache_path(cache_dir, key)
+        os.makedirs(cache_dir, exist_ok=True)
+        ### written aside and renamed, a concurrent reader never sees a partial entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, tokens.to(torch.float16).cpu().numpy())
+        os.replace(tmp_path, path)
+    return tokens
@@ -0,0 +1,57 @@
+import os
+import hashlib
+import numpy as np
+import torch
+
+### the ONNX Runtime sessions of the process, {path: session}
+_SESSIONS = {}
+OPSET = 18
+
+def onnx_cache_path(cache_dir:str, name:str, fingerprint:str, opset:int=OPSET)->str:
+    """the exported graph of a module, keyed by its checkpoint (e.g. camera.dino.checkpoint_fingerprint), the opset and the torch version of the export"""
+    sha = hashlib.sha1()
+    for item in [name, fingerprint, str(opset), torch.__version__]:
+        sha.update(item.encode('utf-8'))
+    return os.path.join(cache_dir, f'{name}_{sha.hexdigest()}.onnx')
+
+def export_onnx(module:torch.nn.Module, examples:tuple, path:str, input_names:list, output_name:str,
+                dynamic_axes:dict=None, opset:int=OPSET):
+    """export a module with one output to `path`
+
+    Args:
+        module (torch.nn.Module): in eval mode, on cpu
+        examples (tuple): the inputs, their shapes are fixed in the graph except the dynamic axes
+        input_names (list): one per input
+        dynamic_axes (dict, optional): {input or output name: {axis: axis name}}. Defaults to None(fixed shapes).
+    """
+    cache_dir, name = os.path.split(path)
+    ### exported aside and moved, a concurrent reader never sees a partial graph,
+    ### large weights go to `name.data` next to the graph, which refers to it by its file name
+    tmp_dir = os.path.join(cache_dir or './', f'.{name}.{os.getpid()}.tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(module, tuple(examples), os.path.join(tmp_dir, name), input_names=list(input_names), output_names=[output_name],
+                          dynamic_axes=dynamic_axes, opset_version=opset)
+    for file in sorted(os.listdir(tmp_dir), key=lambda file: file == name):
+        os.replace(os.path.join(tmp_dir, file), os.path.join(cache_dir or './', file))
+    os.rmdir(tmp_dir)
+
+def get_onnx_session(path:str, num_threads:int=None):
+    """the ONNX Runtime session of an exported graph on the cpu execution provider, created once per process"""
+    if path not in _SESSIONS:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        _SESSIONS[path] = onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+    return _SESSIONS[path]
+
+def release_onnx_sessions():
+    _SESSIONS.clear()
+
+def run_onnx_session(session, *inputs:torch.Tensor)->torch.Tensor:
+    """run a session with one output on tensors, in the order of its inputs, the output is on the device of the first one"""
+    feeds = {node.name: np.ascontiguousarray(tensor.detach().to('cpu', torch.float32).numpy())
+             for node, tensor in zip(session.get_inputs(), inputs)}
+    return torch.from_numpy(session.run(None, feeds)[0]).to(inputs[0].device)
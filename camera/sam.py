@@ -1,7 +1,12 @@
 from segment_anything import SamPredictor, sam_model_registry
+from segment_anything.modeling import Sam, PromptEncoder, MaskDecoder, TwoWayTransformer
+import os
 import numpy as np
 import cv2
+import torch
 import matplotlib.pyplot as plt
+from camera.dino import checkpoint_fingerprint, get_default_device
+from camera.onnx_runtime import onnx_cache_path, export_onnx, get_onnx_session, run_onnx_session
 
 def show_mask(mask, ax, random_color=False):
     if random_color:
@@ -34,13 +39,98 @@ def vis_mask_image(image, mask, points, labels, bbox=None, save_path="./test.png
     plt.axis('off')
     plt.savefig(save_path)
 
+class ImageEncoderStub(torch.nn.Module):
+    """stands for the image encoder of a SAM whose embeddings come from elsewhere, SamPredictor only reads its img_size"""
+
+    def __init__(self, img_size:int=1024) -> None:
+        super().__init__()
+        self.img_size = img_size
+
+def sam_decoder_path(path:str)->str:
+    """the weights of the prompt encoder and the mask decoder saved next to an exported SAM image encoder"""
+    return os.path.splitext(path)[0] + '_decoder.pth'
+
+def build_sam_without_encoder(weights:str)->Sam:
+    """the prompt encoder and the mask decoder of SAM (the same for vit_h, vit_l and vit_b) from their weights
+    saved apart (see sam_decoder_path), the checkpoint with the image encoder is never read
+
+    Returns:
+        Sam: with an ImageEncoderStub
+    """
+    prompt_embed_dim, image_size, vit_patch_size = 256, 1024, 16
+    image_embedding_size = image_size // vit_patch_size
+    sam = Sam(
+        image_encoder=ImageEncoderStub(image_size),
+        prompt_encoder=PromptEncoder(
+            embed_dim=prompt_embed_dim,
+            image_embedding_size=(image_embedding_size, image_embedding_size),
+            input_image_size=(image_size, image_size),
+            mask_in_chans=16,
+        ),
+        mask_decoder=MaskDecoder(
+            num_multimask_outputs=3,
+            transformer=TwoWayTransformer(depth=2, embedding_dim=prompt_embed_dim, mlp_dim=2048, num_heads=8),
+            transformer_dim=prompt_embed_dim,
+            iou_head_depth=3,
+            iou_head_hidden_dim=256,
+        ),
+        pixel_mean=[123.675, 116.28, 103.53],
+        pixel_std=[58.395, 57.12, 57.375],
+    )
+    sam.load_state_dict(torch.load(weights, map_location='cpu'))
+    return sam.eval()
+
+class OnnxSamPredictor(SamPredictor):
+    """a SamPredictor whose image embeddings come from an exported image encoder run by ONNX Runtime on cpu,
+    the prompt encoder and the mask decoder stay in torch"""
+
+    def __init__(self, sam_model, path:str, num_threads:int=None) -> None:
+        super().__init__(sam_model)
+        self.session = get_onnx_session(path, num_threads)
+
+    @torch.no_grad()
+    def set_torch_image(self, transformed_image:torch.Tensor, original_image_size:tuple) -> None:
+        """SamPredictor.set_torch_image with the image embeddings from the session"""
+        self.reset_image()
+        self.original_size = original_image_size
+        self.input_size = tuple(transformed_image.shape[-2:])
+        input_image = self.model.preprocess(transformed_image)
+        self.features = run_onnx_session(self.session, input_image)
+        self.is_image_set = True
+
 class Sam_Detector():
     def __init__(self, sam_checkpoint = "./thirdparty_module/sam_vit_h_4b8939.pth", 
-                 model_type = "vit_h", device = "cuda") -> None:
-
-        sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-        sam.to(device=device)
-        self.predictor = SamPredictor(sam)
+                 model_type = "vit_h", device = None, backend = "torch", onnx_cache_dir = "./thirdparty_module/onnx",
+                 num_threads = None) -> None:
+        """
+        Args:
+            device (optional): of the model, with the 'onnx' backend the embeddings are moved to it. Defaults to None(see get_default_device).
+            backend (str, optional): 'torch' or 'onnx' (the image encoder by ONNX Runtime on cpu, see OnnxSamPredictor). Defaults to 'torch'.
+            onnx_cache_dir (str, optional): the exported encoder of the 'onnx' backend, one per checkpoint. Defaults to './thirdparty_module/onnx'.
+            num_threads (int, optional): the threads of ONNX Runtime. Defaults to None(its default).
+        """
+        device = device or get_default_device()
+        if backend == 'torch':
+            sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
+            self.predictor = SamPredictor(sam.to(device=device))
+        elif backend == 'onnx':
+            path = onnx_cache_path(onnx_cache_dir, f'sam_image_encoder_{model_type}', checkpoint_fingerprint(sam_checkpoint))
+            if os.path.isfile(path) and os.path.isfile(sam_decoder_path(path)):
+                sam = build_sam_without_encoder(sam_decoder_path(path))
+            else:
+                sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
+                size = sam.image_encoder.img_size
+                ### saved before the graph, a graph on disk always has them
+                os.makedirs(onnx_cache_dir, exist_ok=True)
+                tmp_path = f'{sam_decoder_path(path)}.{os.getpid()}.tmp'
+                torch.save({key: value for key, value in sam.state_dict().items() if not key.startswith('image_encoder.')}, tmp_path)
+                os.replace(tmp_path, sam_decoder_path(path))
+                export_onnx(sam.image_encoder, (torch.zeros((1, 3, size, size)), ), path, ['img'], 'embeddings')
+                ### the torch encoder is not kept next to the session
+                sam.image_encoder = ImageEncoderStub(size)
+            self.predictor = OnnxSamPredictor(sam.to(device=device), path, num_threads=num_threads)
+        else:
+            raise NotImplementedError
     
     def refine_mask(self, mask_ori, input_point, input_label, step_add_num=2, opt_step:int=3):
 
@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import torch
 import numpy as np
 import trimesh
@@ -12,6 +14,7 @@ from scipy.spatial.transform import Rotation
 import yaml
 from matplotlib import cm
 from optimize.hand_model import robust_compute_rotation_matrix_from_ortho6d
+from optimize.feature_field import FeatureIndex
 
 def read_tranformation(data_path:str='./camera/transform.yaml'):
     with open(data_path, 'r') as f:
@@ -84,6 +87,100 @@ def read_hand_arm(forder_path:str='./camera/hand_arm', name=None):
         return poses[idx]
     return poses
 
+def seed_translations(reference_pts:np.ndarray, reference_desc:torch.Tensor, feature_index:FeatureIndex,
+                      target_points:np.ndarray, num_seeds:int, k:int=4, voxel_size:float=0.02)->np.ndarray:
+    """vote for the translations from the reference scene to the test scene with feature matches
+
+    Every reference query point votes `target_point - reference_point` for each of its k nearest target points
+    in the feature space. The votes are binned into voxels, the means of the most voted voxels are returned.
+
+    Args:
+        reference_pts (np.ndarray): (n, 3) the reference query points
+        reference_desc (torch.Tensor): (n, dim) their descriptors
+        feature_index (FeatureIndex): the index over the features of the target points
+        target_points (np.ndarray): (N, 3)
+        num_seeds (int): the maximum number of translations
+        k (int, optional): matches per reference point. Defaults to 4.
+        voxel_size (float, optional): the bin size of the votes (m). Defaults to 0.02.
+
+    Returns:
+        np.ndarray: (m, 3), m <= num_seeds, sorted by the number of votes
+    """
+    _, index = feature_index.query(reference_desc, k=k)
+    ### (n * k, 3)
+    votes = (target_points[index.cpu().numpy()] - reference_pts[:, None, :]).reshape(-1, 3)
+    cells = np.floor(votes / voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    top = np.argsort(-counts, kind='stable')[:num_seeds]
+    return np.stack([votes[inverse == cell].mean(axis=0) for cell in top])
+
+def reference_cache_path(cache_dir:str, field_hash:str, reference_pose:np.ndarray, n_surface_points:int, tip_aug,
+                         reference_query_pts:np.ndarray)->str:
+    """the entry of the descriptor cache holding the descriptors of a reference pose
+
+    The query points are hashed too, they depend on the surface points sampled by the hand (gripper) model.
+
+    Args:
+        cache_dir (str): directory of the cache
+        field_hash (str): hash of the inputs of the reference field, see prune.hash_field_inputs
+        reference_pose (np.ndarray): (1, D)
+        n_surface_points (int):
+        tip_aug (float): None if not used
+        reference_query_pts (np.ndarray): (n_surface_points, 3)
+
+    Returns:
+        str: path of the entry (.npz)
+    """
+    sha = hashlib.sha1()
+    sha.update(field_hash.encode('utf-8'))
+    sha.update(json.dumps({'n_surface_points': n_surface_points, 'tip_aug': tip_aug}).encode('utf-8'))
+    sha.update(np.ascontiguousarray(reference_pose, dtype=np.float32).tobytes())
+    sha.update(np.ascontiguousarray(reference_query_pts, dtype=np.float32).tobytes())
+    return os.path.join(cache_dir, sha.hexdigest() + '.npz')
+
+def get_reference_descriptors(reference_query_pts:np.ndarray, reference_pose:torch.Tensor, interpolator1, pcd1:np.ndarray,
+                              color_ref1:np.ndarray, reference_fn=None, descriptor_cache:str=None, field_hash:str=None,
+                              n_surface_points:int=None, tip_aug=None, device='cpu'):
+    """the descriptors of the reference query points, read from the descriptor cache when possible
+
+    Args:
+        reference_query_pts (np.ndarray): (n, 3)
+        reference_pose (torch.Tensor): (1, D)
+        interpolator1: the reference interpolator, None if not built yet
+        pcd1 (np.ndarray): the reference points, None if not built yet
+        color_ref1 (np.ndarray): their colors
+        reference_fn (optional): reference_fn() -> (interpolator1, pcd1, color_ref1) builds them on a cache miss
+        descriptor_cache (str, optional): directory of the cache. Defaults to None(no cache).
+        field_hash (str, optional): see reference_cache_path
+        n_surface_points (int, optional): see reference_cache_path
+        tip_aug (optional): see reference_cache_path
+
+    Returns:
+        descriptors: (1, n, dim) torch.Tensor
+        interpolator1, pcd1, color_ref1: as given, or built (read) on the way
+    """
+    path = None
+    if descriptor_cache:
+        path = reference_cache_path(descriptor_cache, field_hash, reference_pose.cpu().numpy(), n_surface_points,
+                                    tip_aug, reference_query_pts)
+        if os.path.isfile(path):
+            data = np.load(path)
+            if pcd1 is None:
+                pcd1, color_ref1 = data['points'], data['colors']
+            return torch.from_numpy(data['descriptors']).to(device), interpolator1, pcd1, color_ref1
+    if interpolator1 is None:
+        interpolator1, pcd1, color_ref1 = reference_fn()
+
+    ### the pc of the reference shape
+    ref_query_pts = torch.from_numpy(reference_query_pts).float().to(device)
+    # get the descriptors for these reference query points
+    reference_act_hat = interpolator1.predict(ref_query_pts[None, :, :]).detach()
+    if path:
+        os.makedirs(descriptor_cache, exist_ok=True)
+        np.savez(path, descriptors=reference_act_hat.cpu().numpy(), points=pcd1, colors=color_ref1)
+    return reference_act_hat, interpolator1, pcd1, color_ref1
+
 def trimesh_show(np_pcd_list, mesh_list, color_add_list=None, color_list=None, rand_color=False, show=True, name=None):
     colormap = cm.get_cmap('brg', len(np_pcd_list))
     colors = [
@@ -130,9 +227,17 @@ class Hand_AlignmentCheck:
                  points_ref:torch.Tensor=None, skip_inverse:bool = False,
                  opt_iterations=1500, opt_nums=500,
                  trimesh_viz=False, hand_file = "./mjcf/shadow_hand_vis.xml",
-                 tip_aug=None, name=None):
+                 tip_aug=None, name=None, num_restarts=10, seeding='uniform',
+                 descriptor_cache:str=None, field_hash:str=None, reference_fn=None):
         ### load the model and set the params
+        ### interpolator1 (and pcd1, color_ref1) may be None when the reference descriptors are cached,
+        ### reference_fn() -> (interpolator1, pcd1, color_ref1) builds them on a cache miss
         self.interpolator1, self.interpolator2 = interpolator1, interpolator2
+        self.descriptor_cache, self.field_hash, self.reference_fn = descriptor_cache, field_hash, reference_fn
+        self.tip_aug = tip_aug
+        ### 'uniform': random restarts above the object, 'feature': restarts seeded by feature matches
+        self.num_restarts = num_restarts
+        self.seeding = seeding
         self.opt_iterations = opt_iterations
         self.viz = trimesh_viz
         self.name = name
@@ -158,7 +263,8 @@ class Hand_AlignmentCheck:
         self.loss_fn = torch.nn.L1Loss()
 
     ###### can sample some pt from the reference frame and then return the best corresponding points in the test frame
-    def sample_pts(self, name='monkey'):
+    def sample_pts(self, name='monkey', save:bool=True):
+        """save (bool): write the poses, the trajectories, the meshes and the image of the result to ./data"""
         # hand_gt_pose = np.load(f'./camera/hand_arm/arm_{name}.npy')
         arm_pose_trasl = np.array([0,0,0])
         arm_pose_rot = np.array([-0.45260642,  0.08248845,  0.37683634, -1.34357664, -1.21226209,1.2337978 ])
@@ -176,26 +282,32 @@ class Hand_AlignmentCheck:
 
         vquery_mesh = self.hand.get_trimesh_data(0)
         hand_gt:np.ndarray = self.hand.get_surface_points()[0].detach().cpu().numpy()
-        self.hand.save_pose('./data/des_ori.npy', hand_gt_pose, False, False)
-        trimesh_show([self.pcd1 ], [vquery_mesh], show=self.viz, name=self.name, color_add_list=[self.color_ref1,])
+        if save:
+            self.hand.save_pose('./data/des_ori.npy', hand_gt_pose, False, False)
         reference_query_pts = hand_gt
-        exit()
-
-        reference_model_input = {}
-        ref_query_pts = torch.from_numpy(reference_query_pts).float().to(self.dev)
-        ### the pc of the reference shape
-        reference_model_input['coords'] = ref_query_pts[None, :, :]
         # get the descriptors for these reference query points
-        reference_act_hat = self.interpolator1.predict(reference_model_input['coords']).detach()
+        reference_act_hat, self.interpolator1, self.pcd1, self.color_ref1 = get_reference_descriptors(
+            reference_query_pts, hand_gt_pose, self.interpolator1, self.pcd1, self.color_ref1, self.reference_fn,
+            self.descriptor_cache, self.field_hash, self.n_opt_pts, self.tip_aug, self.dev)
+        trimesh_show([self.pcd1 ], [vquery_mesh], show=self.viz, name=self.name if save else None, color_add_list=[self.color_ref1,])
 
         best_loss = np.inf
         best_idx = 0
-        M = 10
+        M = self.num_restarts
 
         motion = (torch.rand(M, 31)*0.03).float().to(self.dev)
         motion[:, 2] = float(self.pcd2[:, 2].max()) + (torch.rand(M)*0.1 + 0.2)[None, :].float().to(self.dev)
         motion[:, 0:2] = (torch.rand(M, 2)*0.2).float().to(self.dev)
         motion[:, 3:9] = torch.from_numpy(np.array([0,-1,0,0,0,1])[None, :].repeat(M, axis=0)).to(self.dev)
+        if self.seeding == 'feature':
+            ### start from the reference pose moved by the most voted translations
+            translations = seed_translations(reference_query_pts, reference_act_hat[0], FeatureIndex(self.interpolator2.get_features()),
+                                             self.pcd2, M)
+            seeded = translations.shape[0]
+            motion[:seeded] = hand_gt_pose[0]
+            motion[:seeded, :3] += torch.from_numpy(translations).float().to(self.dev)
+        elif self.seeding != 'uniform':
+            raise NotImplementedError
 
         ori_rotm = torch.from_numpy(np.array([0., 0 ,-1,-1,0,0,0,1,0]).reshape((3,3))).to(self.dev).to(torch.float32)
         motion.requires_grad_()
@@ -308,6 +420,7 @@ class Hand_AlignmentCheck:
             best_idx = torch.argmin(losses).item()
 
         best_loss = losses[best_idx]
+        self.best_loss = best_loss.item()
         print('best loss: %f, best_idx: %d' % (best_loss, best_idx))
 
         best_X = X_new[best_idx].detach().cpu().numpy()
@@ -321,19 +434,19 @@ class Hand_AlignmentCheck:
         vpcd1 += offset
         vquery1 += offset
         vquery_mesh.apply_translation(offset)
-        self.hand.save_pose('./data/des_final.npy', motion[best_idx][None, ...])
-
         best_execution_traj = np.stack(execution_traj_list[best_idx], axis=0)
-        np.save('./data/execution_traj.npy', best_execution_traj)
-        np.save('./data/pcd_traj.npy', pcd_traj_list[best_idx])
-        np.save('./data/best_X.npy', best_X)
-        vquery_mesh.export('./data/vquery_mesh.stl', file_type='stl')
-        X_mesh.export('./data/X_mesh.stl', file_type='stl')
+        if save:
+            self.hand.save_pose('./data/des_final.npy', motion[best_idx][None, ...])
+            np.save('./data/execution_traj.npy', best_execution_traj)
+            np.save('./data/pcd_traj.npy', pcd_traj_list[best_idx])
+            np.save('./data/best_X.npy', best_X)
+            vquery_mesh.export('./data/vquery_mesh.stl', file_type='stl')
+            X_mesh.export('./data/X_mesh.stl', file_type='stl')
 
         if self.color_ref1 is not None and self.color_ref2 is not None:
-            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx]], [vquery_mesh, X_mesh], show=self.viz, name=self.name, color_add_list=[self.color_ref1, self.color_ref2])
+            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx]], [vquery_mesh, X_mesh], show=self.viz, name=self.name if save else None, color_add_list=[self.color_ref1, self.color_ref2])
         else:
-            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx]], [vquery_mesh, X_mesh], show=self.viz, name=self.name)
+            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx]], [vquery_mesh, X_mesh], show=self.viz, name=self.name if save else None)
 
 
 class Gripper_AlignmentCheck:
@@ -344,9 +457,17 @@ class Gripper_AlignmentCheck:
                  points_ref:torch.Tensor=None, skip_inverse:bool = False,
                  opt_iterations=1500, opt_nums=500,
                  trimesh_viz=False, hand_file = "mjcf/shadow_hand_wrist_free.xml",
-                 tip_aug=None, name=None):
+                 tip_aug=None, name=None, num_restarts=10, seeding='uniform',
+                 descriptor_cache:str=None, field_hash:str=None, reference_fn=None):
         ### load the model and set the params
+        ### interpolator1 (and pcd1, color_ref1) may be None when the reference descriptors are cached,
+        ### reference_fn() -> (interpolator1, pcd1, color_ref1) builds them on a cache miss
         self.interpolator1, self.interpolator2 = interpolator1, interpolator2
+        self.descriptor_cache, self.field_hash, self.reference_fn = descriptor_cache, field_hash, reference_fn
+        self.tip_aug = tip_aug
+        ### 'uniform': random restarts above the object, 'feature': restarts seeded by feature matches
+        self.num_restarts = num_restarts
+        self.seeding = seeding
         self.opt_iterations = opt_iterations
         self.viz = trimesh_viz
         self.name = name
@@ -372,7 +493,9 @@ class Gripper_AlignmentCheck:
         self.loss_fn = torch.nn.L1Loss()
 
     ###### can sample some pt from the reference frame and then return the best corresponding points in the test frame
-    def sample_pts(self, hand_gt_pose: torch.Tensor = None):
+    def sample_pts(self, name=None, hand_gt_pose: torch.Tensor = None, save:bool=True):
+        """name is not used, it keeps the call of Hand_AlignmentCheck.sample_pts,
+        save (bool): write the poses, the trajectory and the image of the result to ./data"""
 
 
         gripper_gt_pose = torch.zeros((1, 9)).float().to(self.dev)
@@ -380,27 +503,35 @@ class Gripper_AlignmentCheck:
         self.gripper.set_parameters(gripper_gt_pose)
         vquery_mesh = self.gripper.get_trimesh_data(0)
         gripper_gt:np.ndarray = self.gripper.get_surface_points()[0].detach().cpu().numpy()
-        self.gripper.save_pose('./data/des_gripper_ori.npy', gripper_gt_pose)
+        if save:
+            self.gripper.save_pose('./data/des_gripper_ori.npy', gripper_gt_pose)
         # trimesh_show([self.pcd1 ], [vquery_mesh], show=self.viz, name=self.name, color_add_list=[self.color_ref1,])
         reference_query_pts = gripper_gt
         # exit()
 
-        reference_model_input = {}
-        ref_query_pts = torch.from_numpy(reference_query_pts).float().to(self.dev)
-        ### the pc of the reference shape
-        reference_model_input['coords'] = ref_query_pts[None, :, :]
         # get the descriptors for these reference query points
-        reference_act_hat = self.interpolator1.predict(reference_model_input['coords']).detach()
+        reference_act_hat, self.interpolator1, self.pcd1, self.color_ref1 = get_reference_descriptors(
+            reference_query_pts, gripper_gt_pose, self.interpolator1, self.pcd1, self.color_ref1, self.reference_fn,
+            self.descriptor_cache, self.field_hash, self.n_opt_pts, self.tip_aug, self.dev)
 
 
         best_loss = np.inf
         best_idx = 0
-        M = 10
+        M = self.num_restarts
 
         motion = (torch.rand(M, 9)*0.3).float().to(self.dev)
 
         motion[:, 2] = float(self.pcd2[:, 2].max()) + (torch.rand(M)*0.1)[None, :].float().to(self.dev)
         motion[:, 0:2] = (torch.rand(M, 2)*0.4).float().to(self.dev) - 0.2
+        if self.seeding == 'feature':
+            ### start from the reference pose moved by the most voted translations
+            translations = seed_translations(reference_query_pts, reference_act_hat[0], FeatureIndex(self.interpolator2.get_features()),
+                                             self.pcd2, M)
+            seeded = translations.shape[0]
+            motion[:seeded] = gripper_gt_pose[0]
+            motion[:seeded, :3] += torch.from_numpy(translations).float().to(self.dev)
+        elif self.seeding != 'uniform':
+            raise NotImplementedError
         motion.requires_grad_()
         opt = torch.optim.Adam([motion], lr=1e-2)
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(opt, T_max=self.opt_iterations/ 50, eta_min=1e-4)
@@ -453,6 +584,7 @@ class Gripper_AlignmentCheck:
 
         best_idx = torch.argmin(losses).item()
         best_loss = losses[best_idx]
+        self.best_loss = best_loss.item()
         print('best loss: %f, best_idx: %d' % (best_loss, best_idx))
 
         best_X = X_new[best_idx].detach().cpu().numpy()
@@ -467,13 +599,13 @@ class Gripper_AlignmentCheck:
         vquery1 += offset
         vquery_mesh.apply_translation(offset)
         motion_best = motion[best_idx].detach().cpu().numpy()
-        self.gripper.save_pose('./data/des_final.npy', motion[best_idx][None, ...])
-
         best_execution_traj = np.stack(execution_traj_list[best_idx], axis=0)
         print(best_execution_traj.shape)
-        np.save('./data/execution_traj.npy', best_execution_traj)
+        if save:
+            self.gripper.save_pose('./data/des_final.npy', motion[best_idx][None, ...])
+            np.save('./data/execution_traj.npy', best_execution_traj)
 
         if self.color_ref1 is not None and self.color_ref2 is not None:
-            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx], best_execution_traj[-40:, :3]], [vquery_mesh, X_mesh], show=self.viz, name=self.name, color_add_list=[self.color_ref1, self.color_ref2])
+            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx], best_execution_traj[-40:, :3]], [vquery_mesh, X_mesh], show=self.viz, name=self.name if save else None, color_add_list=[self.color_ref1, self.color_ref2])
         else:
-            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx]], [vquery_mesh, X_mesh], show=self.viz, name=self.name)
\ No newline at end of file
+            trimesh_show([vpcd1, vquery1 , self.pcd2, best_X, pcd_traj_list[best_idx]], [vquery_mesh, X_mesh], show=self.viz, name=self.name if save else None)
\ No newline at end of file
@@ -0,0 +1,414 @@
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.spatial import cKDTree
+
+FEATURE_DTYPES = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16, 'int8': torch.int8}
+
+def quantize_features(features:torch.Tensor, dtype:str='float32', scale:torch.Tensor=None):
+    """store the features in a reduced precision
+
+    Args:
+        features (torch.Tensor): (n, dim) float
+        dtype (str, optional): 'float32', 'float16', 'bfloat16' or 'int8' (symmetric, one scale per channel). Defaults to 'float32'.
+        scale (torch.Tensor, optional): (dim, ) reuse the scale of already quantized features for 'int8',
+            larger values are clipped. Defaults to None(fit the scale to the features).
+
+    Returns:
+        features (torch.Tensor): (n, dim) in dtype
+        scale (torch.Tensor): (dim, ) float32 for 'int8', else None
+    """
+    if dtype == 'int8':
+        if scale is None:
+            scale = features.abs().max(dim=0)[0].to(torch.float32).clamp_min(1e-12) / 127
+        return torch.round(features / scale).clamp(-127, 127).to(torch.int8), scale
+    return features.to(FEATURE_DTYPES[dtype]), None
+
+def dequantize_features(features:torch.Tensor, scale:torch.Tensor=None)->torch.Tensor:
+    """(n, dim) stored features -> (n, dim) float32"""
+    features = features.to(torch.float32)
+    return features if scale is None else features * scale
+
+class VoxelFeatureGrid:
+    """The IDW feature field baked into a bounded 3D grid.
+
+    The field never changes during the optimization, so the interpolation is evaluated once on the
+    grid nodes and every later query is a differentiable trilinear `grid_sample`, O(1) per point.
+    """
+
+    def __init__(self, predict_fn, points:torch.Tensor, voxel_size:float=0.005, bounds=None, padding:float=0.05,
+                 batch_size:int=1024, num_check:int=2048) -> None:
+        """Bake the field
+
+        Args:
+            predict_fn (callable): the exact interpolation, (q, 3) -> (q, dim)
+            points (torch.Tensor): (n, 3) the field points, used for the default bounds
+            voxel_size (float, optional): the edge length of a voxel (m). Defaults to 0.005.
+            bounds (list, optional): [[x_min, y_min, z_min], [x_max, y_max, z_max]].
+                Defaults to None(the bounding box of the points enlarged by `padding`).
+            padding (float, optional): Defaults to 0.05.
+            batch_size (int, optional): number of grid nodes interpolated at once. Defaults to 1024.
+            num_check (int, optional): number of random queries used to measure the deviation. Defaults to 2048.
+        """
+        start_time = time.time()
+        self.dev = points.device
+        if bounds is None:
+            lower = points.min(dim=0)[0] - padding
+            upper = points.max(dim=0)[0] + padding
+        else:
+            lower = torch.tensor(bounds[0], dtype=torch.float32, device=self.dev)
+            upper = torch.tensor(bounds[1], dtype=torch.float32, device=self.dev)
+        self.voxel_size = voxel_size
+        ### (3, ) number of nodes along x, y, z
+        self.shape = torch.ceil((upper - lower) / voxel_size).long() + 1
+        self.lower = lower
+        self.upper = lower + (self.shape - 1) * voxel_size
+
+        axes = [self.lower[i] + torch.arange(self.shape[i], device=self.dev) * voxel_size for i in range(3)]
+        ### indexing 'ij' on (z, y, x) gives the (D, H, W) layout of grid_sample
+        zz, yy, xx = torch.meshgrid(axes[2], axes[1], axes[0], indexing='ij')
+        nodes = torch.stack([xx, yy, zz], dim=-1).reshape(-1, 3)
+        with torch.no_grad():
+            volume = torch.cat([predict_fn(nodes[i:i + batch_size]) for i in range(0, nodes.shape[0], batch_size)], dim=0)
+        ### (1, dim, D, H, W)
+        self.volume = volume.reshape(*zz.shape, -1).permute(3, 0, 1, 2)[None]
+        self.build_time = time.time() - start_time
+
+        with torch.no_grad():
+            ### a private generator keeps the global seed of the optimization untouched
+            generator = torch.Generator(device=self.dev).manual_seed(0)
+            check_points = self.lower + torch.rand((num_check, 3), device=self.dev, generator=generator) * (self.upper - self.lower)
+            self.max_deviation = (self.sample(check_points) - predict_fn(check_points)).abs().max().item()
+        print('grid shape: {}, build time: {:.2f}s, max deviation from exact IDW: {:.6f}'.format(
+            self.shape.tolist(), self.build_time, self.max_deviation))
+
+    def contains(self, query_points:torch.Tensor)->torch.Tensor:
+        """(q, 3) -> (q, ) whether the queries are inside the baked volume"""
+        return ((query_points >= self.lower) & (query_points <= self.upper)).all(dim=-1)
+
+    def sample(self, query_points:torch.Tensor)->torch.Tensor:
+        """trilinear lookup, differentiable w.r.t. the query points
+
+        Args:
+            query_points (torch.Tensor): (q, 3)
+
+        Returns:
+            torch.Tensor: (q, dim), zeros outside the volume
+        """
+        grid = (query_points - self.lower) / (self.upper - self.lower) * 2 - 1
+        features = F.grid_sample(self.volume, grid[None, :, None, None, :], mode='bilinear',
+                                 padding_mode='zeros', align_corners=True)
+        ### (1, dim, q, 1, 1) -> (q, dim)
+        return features[0, :, :, 0, 0].T
+
+class HashFeatureGrid:
+    """A sparse voxel hash grid of the IDW feature field.
+
+    Only the cells within `dilation` voxels of the observed points are allocated, so the memory scales with
+    the surface area of the objects instead of the volume of the workspace. The hash is a sorted array of
+    the linearized node coordinates, looked up with `torch.searchsorted`.
+    """
+
+    def __init__(self, predict_fn, points:torch.Tensor, voxel_size:float=0.002, dilation:int=2,
+                 batch_size:int=1024) -> None:
+        """Bake the field on the allocated nodes
+
+        Args:
+            predict_fn (callable): the exact interpolation, (q, 3) -> (q, dim)
+            points (torch.Tensor): (n, 3) the observed field points
+            voxel_size (float, optional): the edge length of a voxel (m). Defaults to 0.002.
+            dilation (int, optional): number of voxel rings allocated around the observed points. Defaults to 2.
+            batch_size (int, optional): number of nodes interpolated at once. Defaults to 1024.
+        """
+        start_time = time.time()
+        self.dev = points.device
+        self.voxel_size = voxel_size
+        self.origin = points.min(dim=0)[0] - (dilation + 1) * voxel_size
+        ### the number of nodes along x, y, z, used to linearize the coordinates
+        self.extent = torch.ceil((points.max(dim=0)[0] - self.origin) / voxel_size).long() + dilation + 2
+        self.corner_offsets = torch.stack(torch.meshgrid(*[torch.arange(2, device=self.dev)] * 3, indexing='ij'), dim=-1).reshape(-1, 3)
+
+        cells = torch.unique(torch.floor((points - self.origin) / voxel_size).long(), dim=0)
+        ring = torch.arange(-dilation, dilation + 1, device=self.dev)
+        ring_offsets = torch.stack(torch.meshgrid(ring, ring, ring, indexing='ij'), dim=-1).reshape(-1, 3)
+        cells = torch.unique((cells[:, None, :] + ring_offsets[None]).reshape(-1, 3), dim=0)
+        nodes = torch.unique((cells[:, None, :] + self.corner_offsets[None]).reshape(-1, 3), dim=0)
+        keys = self.get_keys(nodes)
+        self.keys, order = torch.sort(keys)
+        nodes = nodes[order].to(torch.float32) * voxel_size + self.origin
+        with torch.no_grad():
+            self.node_features = torch.cat([predict_fn(nodes[i:i + batch_size]) for i in range(0, nodes.shape[0], batch_size)], dim=0)
+        self.build_time = time.time() - start_time
+        print('hash grid nodes: {} ({:.1f}MB), build time: {:.2f}s'.format(
+            self.keys.shape[0], self.node_features.numel() * self.node_features.element_size() / 2**20, self.build_time))
+
+    def get_keys(self, coords:torch.Tensor)->torch.Tensor:
+        """(..., 3) integer node coordinates -> (..., ) linear keys"""
+        return coords[..., 0] + self.extent[0] * (coords[..., 1] + self.extent[1] * coords[..., 2])
+
+    def sample(self, query_points:torch.Tensor):
+        """trilinear lookup, differentiable w.r.t. the query points
+
+        Args:
+            query_points (torch.Tensor): (q, 3)
+
+        Returns:
+            features (torch.Tensor): (q, dim), zeros where the cell is not allocated
+            found (torch.Tensor): (q, ) whether all the 8 corners of the query's cell are allocated
+        """
+        coords = (query_points - self.origin) / self.voxel_size
+        base = torch.floor(coords.detach()).long()
+        frac = coords - base
+        ### (q, 8, 3)
+        corners = base[:, None, :] + self.corner_offsets[None]
+        in_range = ((corners >= 0) & (corners < self.extent)).all(dim=-1)
+        keys = self.get_keys(corners)
+        index = torch.searchsorted(self.keys, keys).clamp(max=self.keys.shape[0] - 1)
+        found = in_range & (self.keys[index] == keys)
+        found = found.all(dim=-1)
+        ### (q, 8) trilinear weights
+        weights = torch.where(self.corner_offsets[None].bool(), frac[:, None, :], 1 - frac[:, None, :]).prod(dim=-1)
+        weights = weights * found[:, None]
+        features = torch.einsum('qc,qcf->qf', weights, self.node_features[index])
+        return features, found
+
+class IDWFunction(torch.autograd.Function):
+    """Inverse distance weighting with a memory-lean backward.
+
+    Nothing of size (num_query_points, num_points) is kept for the backward: only the queries, the output and
+    the weight denominator are saved, and the weights are recomputed tile by tile. The gradient is only
+    returned for the query points, the field points and features are constants.
+
+        f(q) = sum_j w_j F_j / W,  w_j = 1 / (d_j + eps)^2,  W = sum_j w_j
+        df/dq = sum_j (F_j - f) dw_j/dd_j (q - p_j) / d_j / W
+    """
+
+    @staticmethod
+    def forward(ctx, query_points:torch.Tensor, points:torch.Tensor, features:torch.Tensor, feature_scale:torch.Tensor,
+                query_chunk:int, point_chunk:int)->torch.Tensor:
+        """
+        Args:
+            query_points (torch.Tensor): (q, 3)
+            points (torch.Tensor): (n, 3)
+            features (torch.Tensor): (n, dim) stored features, dequantized tile by tile
+            feature_scale (torch.Tensor): (dim, ) the per-channel scale of int8 features, or None
+            query_chunk (int): queries per tile
+            point_chunk (int): field points per tile
+
+        Returns:
+            torch.Tensor: (q, dim)
+        """
+        output_ls, denominator_ls = [], []
+        for i in range(0, query_points.shape[0], query_chunk):
+            query = query_points[i:i + query_chunk]
+            numerator, denominator = 0, 0
+            for j in range(0, points.shape[0], point_chunk):
+                dists = torch.norm(points[None, j:j + point_chunk] - query[:, None, :], dim=-1)
+                weights = 1 / (dists + 1e-10)**2
+                numerator = numerator + torch.mm(weights, dequantize_features(features[j:j + point_chunk], feature_scale))
+                denominator = denominator + torch.sum(weights, dim=1, keepdim=True)
+            output_ls.append(numerator / denominator)
+            denominator_ls.append(denominator)
+        output = torch.cat(output_ls, dim=0)
+        ctx.save_for_backward(query_points, points, features, output, torch.cat(denominator_ls, dim=0))
+        ctx.feature_scale = feature_scale
+        ctx.query_chunk, ctx.point_chunk = query_chunk, point_chunk
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output:torch.Tensor):
+        query_points, points, features, output, denominator = ctx.saved_tensors
+        grad_query = torch.zeros_like(query_points)
+        for i in range(0, query_points.shape[0], ctx.query_chunk):
+            query = query_points[i:i + ctx.query_chunk]
+            grad = grad_output[i:i + ctx.query_chunk]
+            ### g . f, (tile_q, 1)
+            grad_dot_output = torch.sum(grad * output[i:i + ctx.query_chunk], dim=1, keepdim=True)
+            for j in range(0, points.shape[0], ctx.point_chunk):
+                diff = query[:, None, :] - points[None, j:j + ctx.point_chunk]
+                dists = torch.norm(diff, dim=-1)
+                ### dw/dd / d, (tile_q, tile_p), zero where the query sits on a field point (as torch.norm does)
+                grad_weights = torch.where(dists > 0, -2 / ((dists + 1e-10)**3 * dists), 0)
+                ### g . (F_j - f), (tile_q, tile_p)
+                coef = torch.mm(grad, dequantize_features(features[j:j + ctx.point_chunk], ctx.feature_scale).T) - grad_dot_output
+                coef = coef * grad_weights
+                grad_query[i:i + ctx.query_chunk] += torch.einsum('qp,qpd->qd', coef, diff)
+            grad_query[i:i + ctx.query_chunk] /= denominator[i:i + ctx.query_chunk]
+        return grad_query, None, None, None, None, None
+
+class FeatureOctree:
+    """Barnes-Hut style approximation of the IDW feature field.
+
+    Every node of an octree over the field points stores its point count, centroid and feature sum. A node
+    whose edge length is smaller than `theta` times its distance to the query is evaluated as one pseudo-point
+    at its centroid (weight count / d^2, weighted feature sum / d^2), otherwise it is opened. Leaves that are
+    opened are evaluated exactly, so theta=0 gives the exact IDW and the cost is O(q log n) for theta > 0.
+    """
+
+    def __init__(self, points:torch.Tensor, features:torch.Tensor, theta:float=0.5, leaf_size:int=32,
+                 max_depth:int=16, max_bytes:int=1 << 26, predict_fn=None, num_check:int=256) -> None:
+        """Build the octree
+
+        Args:
+            points (torch.Tensor): (n, 3)
+            features (torch.Tensor): (n, dim)
+            theta (float, optional): the accuracy parameter, smaller is more accurate. Defaults to 0.5.
+            leaf_size (int, optional): maximum number of points in a leaf. Defaults to 32.
+            max_depth (int, optional): Defaults to 16.
+            max_bytes (int, optional): memory budget of the gathered features of one evaluation step. Defaults to 64MB.
+            predict_fn (callable, optional): the exact interpolation, used to report the deviation. Defaults to None.
+            num_check (int, optional): number of random queries used to measure the deviation. Defaults to 256.
+        """
+        start_time = time.time()
+        self.dev = points.device
+        self.theta = theta
+        self.max_bytes = max_bytes
+        self.points = points
+        self.features = features
+        points_np = points.detach().cpu().numpy()
+        features_np = features.detach().cpu().numpy().astype('float64')
+
+        sizes, centroids, counts, feature_sums, children, leaf_ids, leaves = [], [], [], [], [], [], []
+        def build(index, lower, size, depth):
+            node_id = len(sizes)
+            sizes.append(size)
+            centroids.append(points_np[index].mean(axis=0))
+            counts.append(len(index))
+            feature_sums.append(features_np[index].sum(axis=0))
+            children.append([-1] * 8)
+            leaf_ids.append(-1)
+            if len(index) <= leaf_size or depth == max_depth:
+                leaf_ids[node_id] = len(leaves)
+                leaves.append(index)
+                return node_id
+            octant = ((points_np[index] >= lower + size / 2) * [1, 2, 4]).sum(axis=-1)
+            for i in range(8):
+                if (octant == i).any():
+                    child_lower = lower + size / 2 * ((i >> np.arange(3)) & 1)
+                    children[node_id][i] = build(index[octant == i], child_lower, size / 2, depth + 1)
+            return node_id
+        lower = points_np.min(axis=0)
+        build(np.arange(points_np.shape[0]), lower, float((points_np.max(axis=0) - lower).max()) + 1e-6, 0)
+
+        self.size = torch.tensor(sizes, dtype=torch.float32, device=self.dev)
+        self.centroid = torch.from_numpy(np.stack(centroids).astype('float32')).to(self.dev)
+        self.count = torch.tensor(counts, dtype=torch.float32, device=self.dev)
+        self.feature_sum = torch.from_numpy(np.stack(feature_sums).astype('float32')).to(self.dev)
+        self.children = torch.tensor(children, dtype=torch.long, device=self.dev)
+        self.leaf_id = torch.tensor(leaf_ids, dtype=torch.long, device=self.dev)
+        ### (num_leaves, max leaf size), padded with -1
+        leaf_table = -np.ones((len(leaves), max(len(leaf) for leaf in leaves)), dtype=np.int64)
+        for i, leaf in enumerate(leaves):
+            leaf_table[i, :len(leaf)] = leaf
+        self.leaf_table = torch.from_numpy(leaf_table).to(self.dev)
+        self.build_time = time.time() - start_time
+
+        if predict_fn is not None:
+            with torch.no_grad():
+                generator = torch.Generator(device=self.dev).manual_seed(0)
+                lower, upper = points.min(dim=0)[0], points.max(dim=0)[0]
+                check_points = lower + torch.rand((num_check, 3), device=self.dev, generator=generator) * (upper - lower)
+                self.max_deviation = (self.predict(check_points) - predict_fn(check_points)).abs().max().item()
+            print('octree nodes: {}, leaves: {}, build time: {:.2f}s, max deviation from exact IDW (theta={}): {:.6f}'.format(
+                len(sizes), len(leaves), self.build_time, theta, self.max_deviation))
+
+    def predict(self, query_points:torch.Tensor)->torch.Tensor:
+        """traverse the octree for all the queries at once, differentiable w.r.t. the query points
+
+        Args:
+            query_points (torch.Tensor): (q, 3)
+
+        Returns:
+            torch.Tensor: (q, dim)
+        """
+        numerator = query_points.new_zeros((query_points.shape[0], self.features.shape[1]))
+        denominator = query_points.new_zeros((query_points.shape[0], 1))
+        ### the frontier of (query, node) pairs, starting from the root
+        query_index = torch.arange(query_points.shape[0], device=self.dev)
+        node_index = torch.zeros_like(query_index)
+        while query_index.numel() > 0:
+            dists = torch.norm(query_points[query_index] - self.centroid[node_index], dim=-1)
+            far = self.size[node_index] < self.theta * dists.detach()
+            leaf = ~far & (self.leaf_id[node_index] >= 0)
+            opened = ~far & ~leaf
+
+            weights = 1 / (dists[far] + 1e-10)**2
+            numerator, denominator = self.accumulate(numerator, denominator, query_points, query_index[far],
+                                                     node_index[far], weights=weights)
+            numerator, denominator = self.accumulate(numerator, denominator, query_points, query_index[leaf],
+                                                     node_index[leaf])
+
+            children = self.children[node_index[opened]]
+            query_index = query_index[opened][:, None].expand(-1, 8)[children >= 0]
+            node_index = children[children >= 0]
+        return numerator / denominator
+
+    def accumulate(self, numerator, denominator, query_points, query_index, node_index, weights=None):
+        """add the contributions of the (query, node) pairs, in chunks of max_bytes
+
+        Args:
+            query_points (torch.Tensor): (q, 3)
+            query_index (torch.Tensor): (p, )
+            node_index (torch.Tensor): (p, )
+            weights (torch.Tensor, optional): (p, ) the pseudo-point weights 1 / d^2 of far nodes.
+                Defaults to None(the nodes are leaves, evaluated exactly).
+        """
+        if weights is not None:
+            chunk = max(1, self.max_bytes // (self.features.shape[1] * self.features.element_size()))
+        else:
+            chunk = max(1, self.max_bytes // (self.leaf_table.shape[1] * (self.features.shape[1] + 5) * self.features.element_size()))
+        for i in range(0, query_index.shape[0], chunk):
+            query, node = query_index[i:i + chunk], node_index[i:i + chunk]
+            if weights is not None:
+                contribution = self.feature_sum[node] * weights[i:i + chunk, None]
+                weight_sum = (weights[i:i + chunk] * self.count[node])[:, None]
+            else:
+                rows = self.leaf_table[self.leaf_id[node]]
+                valid = rows >= 0
+                rows = rows.clamp(min=0)
+                leaf_dists = torch.norm(query_points[query][:, None, :] - self.points[rows], dim=-1)
+                leaf_weights = valid / (leaf_dists + 1e-10)**2
+                contribution = torch.einsum('pl,plf->pf', leaf_weights, self.features[rows])
+                weight_sum = leaf_weights.sum(dim=1, keepdim=True)
+            numerator = numerator.index_add(0, query, contribution)
+            denominator = denominator.index_add(0, query, weight_sum)
+        return numerator, denominator
+
+class FeatureIndex:
+    """Approximate nearest neighbours in the feature space.
+
+    A KD-tree is built over a low dimensional PCA projection of the features, its candidates are
+    re-ranked with the exact L2 distance in the full feature space.
+    """
+
+    def __init__(self, features:torch.Tensor, proj_dim:int=16, num_candidates:int=32) -> None:
+        """
+        Args:
+            features (torch.Tensor): (n, dim)
+            proj_dim (int, optional): dimension of the projection searched by the KD-tree. Defaults to 16.
+            num_candidates (int, optional): candidates re-ranked per query. Defaults to 32.
+        """
+        self.features = features.to(torch.float32)
+        self.mean = self.features.mean(dim=0)
+        proj_dim = min(proj_dim, *self.features.shape)
+        _, _, self.proj = torch.pca_lowrank(self.features - self.mean, q=proj_dim, center=False)
+        self.num_candidates = min(num_candidates, self.features.shape[0])
+        self.tree = cKDTree(((self.features - self.mean) @ self.proj).cpu().numpy())
+
+    def query(self, descriptors:torch.Tensor, k:int=4):
+        """
+        Args:
+            descriptors (torch.Tensor): (m, dim)
+            k (int, optional): Defaults to 4.
+
+        Returns:
+            dists (torch.Tensor): (m, k) L2 distances in the full feature space
+            index (torch.Tensor): (m, k) indices of the field points
+        """
+        descriptors = descriptors.to(self.features.device, torch.float32)
+        _, candidates = self.tree.query(((descriptors - self.mean) @ self.proj).cpu().numpy(), k=self.num_candidates)
+        candidates = torch.from_numpy(candidates.reshape(descriptors.shape[0], -1)).to(self.features.device)
+        dists = torch.norm(self.features[candidates] - descriptors[:, None, :], dim=-1)
+        dists, nearest = torch.topk(dists, min(k, candidates.shape[1]), dim=1, largest=False)
+        return dists, torch.gather(candidates, 1, nearest)
@@ -3,22 +3,55 @@ import torch
 import numpy as np
 import open3d as o3d
 from prune.tools import *
-from prune.prune_3D import find_match_3D, find_match_3D_quotient, vote_3D
+from prune.prune_3D import find_match_3D, find_match_3D_quotient, vote_3D, downsample_to_budget, fuse_views
+from prune.field import FeatureField, save_feature_field, load_feature_field, fit_projection, project_features,\
+    save_projection, load_projection, hash_field_inputs
+from prune.incremental import IncrementalFeatureField
 from camera import pipeline
+from camera.dino import get_default_device
 from typing import List
 from scipy.spatial.transform import Rotation
 from refinement.model import LinearProbe, LinearProbe_Thick, LinearProbe_Juicy, LinearProbe_PerScene, LinearProbe_PerSceneThick, LinearProbe_Glayer
 
+def get_workspace_points(raw_points):
+    """the raw points within the workspace box of the robot ('points_ref')"""
+    points_ref, _ = prune_box(raw_points, x=[-0.42, 0.48], y=[-0.56, 0.56], z=[-0.135, 0.8])
+    return points_ref
+
 def get_points_features_from_real(path=None, extrinsics_path:str=None, save=True,
-                                  key=0, name='bear', device='cuda', scale=6,
+                                  key=0, name='bear', device=None, scale=6,
                                    method='binearest-match', dis_threshold=0.1,
                                    quotient_threshold=0.8, verbose=False, model_path=None,
-                                   p0 = 'pyhsics', p1= 'pyhsics'):
+                                   p0 = 'pyhsics', p1= 'pyhsics', feature_dtype='float32', fuse_voxel_size=None,
+                                   max_points=None, downsample='voxel', dino_conf=None, field_hash=None, field_path=None):
+    """build the pruned feature field of a scene and save it as a package, ./data/field_{key}.sdff by default
+
+    The package also holds the unpruned points and colors ('points_vis', 'colors_vis') and the points in the
+    workspace ('points_ref'), so the outputs can be read back from it, see load_points_features_from_field.
+
+    Args:
+        device (optional): of the linear probe. Defaults to None(the device of dino_conf, else see get_default_device).
+        field_hash (str, optional): stored in the meta, see prune.hash_field_inputs. Defaults to None.
+        field_path (str, optional): the package. Defaults to None(./data/field_{key}.sdff).
+
+    Returns:
+        points_select, features_select, colors_select, points_vis, colors_vis, points_ref
+    """
+    device = device or (dino_conf or {}).get('device') or get_default_device()
     if key == 0:
-        points, features, colors, batch_sign, raw_points= pipeline(path, extrinsics_path, save=save, scale=scale, name = name, prune_method=p0, key=0, verbose=verbose)
+        points, features, colors, batch_sign, raw_points= pipeline(path, extrinsics_path, save=save, scale=scale, name = name, prune_method=p0, key=0, verbose=verbose,
+                                                                   dino_conf=dino_conf)
     elif key == 1:
-        points, features, colors, batch_sign, raw_points= pipeline(path, extrinsics_path, save=save, scale=scale, name = name, prune_method=p1, key=1, verbose=verbose)
-    points_ref, _ = prune_box(raw_points, x=[-0.42, 0.48], y=[-0.56, 0.56], z=[-0.135, 0.8])
+        points, features, colors, batch_sign, raw_points= pipeline(path, extrinsics_path, save=save, scale=scale, name = name, prune_method=p1, key=1, verbose=verbose,
+                                                                   dino_conf=dino_conf)
+    points_ref = get_workspace_points(raw_points)
+    view_count = None
+    if fuse_voxel_size:
+        ### merge the near-duplicate points of overlapping views
+        num_raw = points.shape[0]
+        points, features, colors, batch_sign, view_count = fuse_views(points, features, colors, batch_sign, voxel_size=fuse_voxel_size)
+        if verbose:
+            print(f'fused {num_raw} points of object{key} into {points.shape[0]} voxels, mean views per voxel {view_count.float().mean().item():.2f}')
 
     img_num = points.shape[0]
     if method == 'quotient_match':
@@ -36,15 +69,30 @@ def get_points_features_from_real(path=None, extrinsics_path:str=None, save=True
     features_select = features.reshape(-1, features.shape[-1])[index_select]
     batch_sign_select = batch_sign[index_select.to(batch_sign.device)]
     colors_select = colors[index_select.cpu().numpy()]
+    extras = {} if view_count is None else {'view_count': view_count[index_select.cpu()].numpy().astype('int32')}
     if model_path is not None:
         model = LinearProbe_Glayer(768, 768 * 4, 768, g_size=64, ref=True).to(device)
-        model.load_state_dict(torch.load(model_path))
+        model.load_state_dict(torch.load(model_path, map_location=device))
         model.eval()
-        features_select = model(features_select).detach()
+        features_select = model(features_select.to(device)).detach()
+    if max_points and points_select.shape[0] > max_points:
+        ### bound the size of the field, so the interpolation cost does not depend on the scene
+        num_select = points_select.shape[0]
+        points_select, features_select, colors_select, batch_sign_select, inverse = downsample_to_budget(points_select, features_select,
+                                                                        colors_select, batch_sign_select, max_points, method=downsample)
+        if 'view_count' in extras:
+            ### a merged point is seen by at least as many views as any of its points
+            view_count_select, extras['view_count'] = extras['view_count'], np.zeros(points_select.shape[0], dtype='int32')
+            np.maximum.at(extras['view_count'], inverse.numpy(), view_count_select)
+        if verbose:
+            print(f'downsampled {num_select} points of object{key} to {points_select.shape[0]} ({downsample})')
 
-    np.save(f'./data/points_{key}.npy', points_select.cpu().numpy())
-    np.save(f'./data/colors_{key}.npy', colors_select)
-    np.save(f'./data/features_{key}.npy', features_select.cpu().numpy())
+    meta = {'key': key, 'data_path': path, 'scale': scale, 'method': method, 'img_preprocess': p0 if key == 0 else p1,
+            'dis_threshold': dis_threshold, 'quotient_threshold': quotient_threshold, 'model_path': model_path,
+            'fuse_voxel_size': fuse_voxel_size, 'max_points': max_points, 'downsample': downsample, 'field_hash': field_hash}
+    extras.update(points_vis=points.cpu().numpy(), colors_vis=colors, points_ref=points_ref)
+    save_feature_field(field_path or f'./data/field_{key}.sdff', points_select.cpu().numpy(), features_select.cpu().numpy(), colors_select, meta=meta,
+                       feature_dtype=feature_dtype, extras=extras)
 
     if verbose:
         print('features_select: ', features_select.shape)
@@ -52,3 +100,61 @@ def get_points_features_from_real(path=None, extrinsics_path:str=None, save=True
 
     return points_select, features_select, colors_select, points.cpu().numpy(), colors, points_ref
 
+
+def load_points_features_from_field(path:str, field_hash:str=None):
+    """the outputs of get_points_features_from_real read back from its package (memory-mapped)
+
+    Args:
+        path (str): ./data/field_{key}.sdff
+        field_hash (str, optional): the package is only used if it was built from these inputs. Defaults to None(any).
+
+    Returns:
+        FeatureField or None if there is no such package
+    """
+    if not os.path.isfile(path):
+        return None
+    field = load_feature_field(path)
+    if 'points_vis' not in field.arrays or (field_hash is not None and field.meta.get('field_hash') != field_hash):
+        return None
+    return field
+
+def load_views(path=None, extrinsics_path:str=None, save=True, key=0, name='bear', device=None, scale=6,
+               verbose=False, model_path=None, prune_method='pyhsics', views=None, dino_conf=None):
+    """run the pipeline on some of the views (cameras) and apply the linear probe to the features
+
+    Args:
+        device (optional): of the linear probe. Defaults to None(the device of dino_conf, else see get_default_device).
+
+    Returns:
+        points, features, colors, batch_sign, raw_points as the pipeline
+    """
+    device = device or (dino_conf or {}).get('device') or get_default_device()
+    points, features, colors, batch_sign, raw_points = pipeline(path, extrinsics_path, save=save, scale=scale, name=name,
+                                                                prune_method=prune_method, key=key, verbose=verbose, views=views,
+                                                                dino_conf=dino_conf)
+    if model_path is not None:
+        model = LinearProbe_Glayer(768, 768 * 4, 768, g_size=64, ref=True).to(device)
+        model.load_state_dict(torch.load(model_path, map_location=device))
+        model.eval()
+        features = model(features.to(device)).detach()
+    return points, features, colors, batch_sign, raw_points
+
+def get_incremental_field_from_real(path=None, extrinsics_path:str=None, save=True, key=0, name='bear', device=None, scale=6,
+                                    dis_threshold=0.1, verbose=False, model_path=None, prune_method='pyhsics', dino_conf=None):
+    """the incremental counterpart of get_points_features_from_real with the 'vote_3D' method, see IncrementalFeatureField
+
+    Returns:
+        field: IncrementalFeatureField
+        points_ref: the raw points in the workspace box
+    """
+    points, features, colors, batch_sign, raw_points = load_views(path, extrinsics_path, save=save, key=key, name=name, device=device,
+                                                                  scale=scale, verbose=verbose, model_path=model_path,
+                                                                  prune_method=prune_method, dino_conf=dino_conf)
+    points_ref = get_workspace_points(raw_points)
+    field = IncrementalFeatureField(dis_threshold=dis_threshold)
+    for sign in torch.unique(batch_sign).tolist():
+        mask = batch_sign == sign
+        field.add_view(points[mask], features[mask.to(features.device)], colors[mask.numpy()], int(sign))
+    if verbose:
+        print(f'The whole number of points of object{key}: {int(field.select().sum())}')
+    return field, points_ref
@@ -0,0 +1,212 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+### the layout of a feature field package (.sdff):
+### MAGIC | header length (uint64) | json header | arrays, each aligned to ALIGNMENT bytes
+MAGIC = b'SDFFIELD'
+ALIGNMENT = 64
+
+class FeatureField:
+    """A feature field opened from a package, the arrays are memory-mapped (copy-on-write)
+
+    Attributes:
+        points (np.ndarray): (n, 3)
+        features (np.ndarray): (n, dim) as stored, see feature_dtype
+        colors (np.ndarray): (n, 3)
+        meta (dict): scale, prune method, probe checkpoint...
+        feature_dtype (str): 'float32', 'float16', 'bfloat16' (stored as int16 bits) or 'int8'
+        feature_scale (np.ndarray): (dim, ) the per-channel scale of int8 features, else None
+    """
+
+    def __init__(self, arrays:dict, meta:dict) -> None:
+        self.arrays = arrays
+        self.meta = meta
+        self.points = arrays['points']
+        self.features = arrays['features']
+        self.colors = arrays['colors']
+        self.feature_dtype = meta.get('feature_dtype', 'float32')
+        self.feature_scale = arrays.get('feature_scale')
+        ### (n, ) the number of views fused into every point, None if the views were not fused
+        self.view_count = arrays.get('view_count')
+        self._tree = None
+
+    def get_stored_features(self)->torch.Tensor:
+        """the features as a tensor in the stored precision, sharing the mapped memory"""
+        features = torch.from_numpy(self.features)
+        if self.feature_dtype == 'bfloat16':
+            features = features.view(torch.bfloat16)
+        return features
+
+    def get_features(self)->np.ndarray:
+        """(n, dim) float32 features"""
+        if self.feature_dtype == 'float32':
+            return self.features
+        features = self.get_stored_features().to(torch.float32).numpy()
+        return features if self.feature_scale is None else features * self.feature_scale
+
+    @property
+    def tree(self)->cKDTree:
+        """the KD-tree over the points, built on first use (a few milliseconds), nothing executable is stored in a package"""
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+def quantize_features_numpy(features:np.ndarray, dtype:str='float32'):
+    """the on-disk counterpart of optimize.feature_field.quantize_features
+
+    Returns:
+        features (np.ndarray): (n, dim), bfloat16 is kept as its int16 bits since numpy has no bfloat16
+        scale (np.ndarray): (dim, ) float32 for 'int8', else None
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if dtype == 'float32':
+        return features, None
+    elif dtype == 'float16':
+        return features.astype(np.float16), None
+    elif dtype == 'bfloat16':
+        return torch.from_numpy(features).to(torch.bfloat16).view(torch.int16).numpy(), None
+    elif dtype == 'int8':
+        scale = np.maximum(np.abs(features).max(axis=0), 1e-12).astype(np.float32) / 127
+        return np.clip(np.round(features / scale), -127, 127).astype(np.int8), scale
+    else:
+        raise NotImplementedError
+
+def save_feature_field(path:str, points:np.ndarray, features:np.ndarray, colors:np.ndarray, meta:dict=None,
+                       feature_dtype:str='float32', extras:dict=None):
+    """save a feature field as one self-contained package
+
+    Args:
+        path (str): path of the package (.sdff)
+        points (np.ndarray): (n, 3)
+        features (np.ndarray): (n, dim)
+        colors (np.ndarray): (n, 3)
+        meta (dict, optional): json serializable metadata. Defaults to None.
+        feature_dtype (str, optional): 'float32', 'float16', 'bfloat16' or 'int8'. Defaults to 'float32'.
+        extras (dict, optional): more arrays, e.g. the per-point 'view_count'. Defaults to None.
+    """
+    features, feature_scale = quantize_features_numpy(features, feature_dtype)
+    meta = dict(meta or {}, feature_dtype=feature_dtype)
+    arrays = {'points': np.ascontiguousarray(points, dtype=np.float32),
+              'features': np.ascontiguousarray(features),
+              'colors': np.ascontiguousarray(colors)}
+    if feature_scale is not None:
+        arrays['feature_scale'] = feature_scale
+    for name, array in (extras or {}).items():
+        arrays[name] = np.ascontiguousarray(array)
+
+    ### the offsets depend on the header length, so lay out the arrays relative to the data start first
+    table, offset = {}, 0
+    for name, array in arrays.items():
+        table[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'meta': meta, 'arrays': table}).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + table[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+def load_feature_field(path:str)->FeatureField:
+    """open a feature field package by memory-mapping, no array is read until it is used
+
+    Args:
+        path (str): path of the package (.sdff)
+
+    Returns:
+        FeatureField
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a feature field package')
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGNMENT) * ALIGNMENT
+
+    arrays = {}
+    for name, item in header['arrays'].items():
+        shape = tuple(item['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=item['dtype'])
+            continue
+        ### mode 'c' keeps the pages shared between processes until one of them writes
+        arrays[name] = np.memmap(path, dtype=item['dtype'], mode='c', offset=data_start + item['offset'], shape=shape)
+    return FeatureField(arrays, header['meta'])
+
+def fit_projection(features_ls:list, dim:int=64, method:str='pca', seed:int=0):
+    """fit a linear projection of the features to `dim` dimensions, jointly over all the fields
+
+    Args:
+        features_ls (list): list of np.ndarray (n_i, F)
+        dim (int, optional): Defaults to 64.
+        method (str, optional): 'pca' or 'random' (a gaussian random projection). Defaults to 'pca'.
+        seed (int, optional): seed of the random projection. Defaults to 0.
+
+    Returns:
+        mean: np.ndarray (F, )
+        matrix: np.ndarray (F, dim)
+    """
+    features = np.concatenate(features_ls, axis=0).astype(np.float64)
+    if method == 'pca':
+        mean = features.mean(axis=0)
+        centered = features - mean
+        ### eigenvectors of the (F, F) covariance, in ascending order of the eigenvalues
+        _, eig_vecs = np.linalg.eigh(centered.T @ centered)
+        matrix = eig_vecs[:, ::-1][:, :dim]
+    elif method == 'random':
+        mean = np.zeros(features.shape[1])
+        matrix = np.random.default_rng(seed).normal(size=(features.shape[1], dim)) / np.sqrt(dim)
+    else:
+        raise NotImplementedError
+    return mean.astype(np.float32), np.ascontiguousarray(matrix, dtype=np.float32)
+
+def project_features(features:np.ndarray, mean:np.ndarray, matrix:np.ndarray)->np.ndarray:
+    """(n, F) -> (n, dim)"""
+    return (features - mean) @ matrix
+
+def save_projection(path:str, mean:np.ndarray, matrix:np.ndarray, method:str, inputs_hash:str=None):
+    """save a projection with the hash of the inputs it was fitted on (e.g. of the fields, see hash_field_inputs)"""
+    np.savez(path, mean=mean, matrix=matrix, method=method, inputs_hash=inputs_hash or '')
+
+def load_projection(path:str, inputs_hash:str=None):
+    """returns mean (F, ), matrix (F, dim), method, or None if there is none fitted on the inputs of inputs_hash"""
+    if not os.path.isfile(path):
+        return None
+    data = np.load(path)
+    if inputs_hash is not None and str(data['inputs_hash']) != inputs_hash:
+        return None
+    return data['mean'], data['matrix'], str(data['method'])
+
+def hash_field_inputs(data_path:str, extrinsics_path:str, conf:dict=None,
+                      transformation_path:str='./camera/transform.yaml')->str:
+    """a content hash of everything a feature field is built from
+
+    Args:
+        data_path (str): the capture folder, every file in it is hashed
+        extrinsics_path (str): the calibration json
+        conf (dict, optional): json serializable build options (scale, prune method, checkpoints...). Defaults to None.
+        transformation_path (str, optional): hashed as well if it exists. Defaults to './camera/transform.yaml'.
+
+    Returns:
+        str: sha1 hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps(conf or {}, sort_keys=True).encode('utf-8'))
+    files = [extrinsics_path] + ([transformation_path] if os.path.isfile(transformation_path) else [])
+    for root, dirs, names in os.walk(data_path):
+        dirs.sort()
+        files += [os.path.join(root, name) for name in sorted(names)]
+    for file in files:
+        sha.update(os.path.relpath(file, data_path).encode('utf-8'))
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
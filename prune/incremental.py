@@ -0,0 +1,97 @@
+import numpy as np
+import torch
+from prune.prune_3D import IncrementalVote3D
+
+class IncrementalFeatureField:
+    """A feature field pruned by vote_3D, which accepts and drops the points of single camera views
+
+    The points, features and colors of all the views are kept before pruning, every point has a stable id.
+    An interpolator built on get_synced() is kept up to date by sync(), which only removes the points
+    leaving the selection and appends the ones entering it.
+
+    Attributes:
+        features (torch.Tensor): (num, F)
+        colors (np.ndarray): (num, 3)
+        ids (torch.Tensor): (num, ) ascending
+    """
+
+    def __init__(self, dis_threshold=0.1, selected_ratio=0.8, device='cpu'):
+        self.vote = IncrementalVote3D(dis_threshold, device=device)
+        self.selected_ratio = selected_ratio
+        self.features, self.colors = None, None
+        self.ids = torch.zeros((0, ), dtype=torch.long)
+        self.next_id = 0
+        ### the ids of the points in the interpolator, in its order
+        self.synced_ids = None
+
+    @property
+    def points(self)->torch.Tensor:
+        """(num, 3)"""
+        return self.vote.points
+
+    @property
+    def batch_sign(self)->torch.Tensor:
+        """(num, ) (from 1)"""
+        return self.vote.batch_sign
+
+    def add_view(self, points:torch.Tensor, features:torch.Tensor, colors:np.ndarray, batch_sign:int):
+        """add the points of one view, replacing the points it had before
+
+        Args:
+            points (torch.Tensor): (num', 3)
+            features (torch.Tensor): (num', F)
+            colors (np.ndarray): (num', 3)
+            batch_sign (int): the view (from 1)
+        """
+        if (self.batch_sign == batch_sign).any():
+            self.remove_view(batch_sign)
+        self.vote.append(points, batch_sign)
+        self.features = features if self.features is None else torch.cat([self.features, features.to(self.features)])
+        self.colors = colors if self.colors is None else np.concatenate([self.colors, colors], axis=0)
+        self.ids = torch.cat([self.ids, torch.arange(self.next_id, self.next_id + points.shape[0])])
+        self.next_id += points.shape[0]
+
+    def remove_view(self, batch_sign:int):
+        """remove the points of one view"""
+        keep = self.vote.remove(batch_sign).cpu()
+        self.features = self.features[keep.to(self.features.device)]
+        self.colors = self.colors[keep.numpy()]
+        self.ids = self.ids[keep]
+
+    def select(self)->torch.Tensor:
+        """(num, ) bool, the points kept by the vote, `selected_ratio` of all the points as in get_points_features_from_real"""
+        return self.vote.select(int(self.points.shape[0] * self.selected_ratio)).cpu()
+
+    def get_synced(self):
+        """the points in the interpolator, in its order (the selected points before the first sync)
+
+        Returns:
+            points: (m, 3) np.ndarray
+            features: (m, F) np.ndarray
+            colors: (m, 3) np.ndarray
+        """
+        if self.synced_ids is None:
+            self.synced_ids = self.ids[self.select()]
+        index = torch.searchsorted(self.ids, self.synced_ids)
+        return self.points[index.to(self.points.device)].cpu().numpy(), self.features[index.to(self.features.device)].cpu().numpy(), \
+            self.colors[index.numpy()]
+
+    def sync(self, interpolator):
+        """apply the change of the selection to an interpolator built on get_synced()
+
+        Args:
+            interpolator: with append_points(points, features) and remove_points(mask)
+
+        Returns:
+            removed (int), added (int): the number of points
+        """
+        selected_ids = self.ids[self.select()]
+        stale = ~torch.isin(self.synced_ids, selected_ids)
+        new_ids = selected_ids[~torch.isin(selected_ids, self.synced_ids)]
+        if stale.any():
+            interpolator.remove_points(stale.numpy())
+        if new_ids.shape[0] > 0:
+            index = torch.searchsorted(self.ids, new_ids)
+            interpolator.append_points(self.points[index.to(self.points.device)].cpu().numpy(), self.features[index.to(self.features.device)])
+        self.synced_ids = torch.cat([self.synced_ids[~stale], new_ids])
+        return int(stale.sum()), new_ids.shape[0]
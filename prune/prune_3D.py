@@ -172,3 +172,207 @@ def vote_3D(points:torch.Tensor, img_sign:torch.Tensor, img_num, dis_threshold=0
     marker[selected_index] = True
     selected_points = points[marker]
     return selected_points, marker
+
+def average_clusters(inverse:torch.Tensor, points:torch.Tensor, features:torch.Tensor, colors:np.ndarray, batch_sign:torch.Tensor):
+    """average the points, features and colors of every cluster, a cluster keeps the batch sign of its majority
+    (the first view on a tie)
+
+    Args:
+        inverse (torch.Tensor): (num, ) the cluster of every point, from 0
+        points (torch.Tensor): (num, 3)
+        features (torch.Tensor): (num, F)
+        colors (np.ndarray): (num, 3)
+        batch_sign (torch.Tensor): (num, ) (from 1)
+
+    Returns:
+        points: (m, 3), features: (m, F), colors: (m, 3), batch_sign: (m, ),
+        view_count: (m, ) the number of views observing every cluster
+    """
+    inverse = inverse.cpu()
+    num = int(inverse.max()) + 1
+    counts = torch.zeros(num).index_add_(0, inverse, torch.ones(inverse.shape[0]))
+    points_mean = torch.zeros((num, 3)).index_add_(0, inverse, points.cpu().float()) / counts[:, None]
+    features_mean = torch.zeros((num, features.shape[-1]), dtype=features.dtype, device=features.device)
+    features_mean.index_add_(0, inverse.to(features.device), features)
+    features_mean /= counts.to(features_mean)[:, None]
+    colors_mean = torch.zeros((num, 3), dtype=torch.float64).index_add_(0, inverse, torch.from_numpy(colors.astype('float64')))
+    colors_mean = np.round((colors_mean / counts[:, None]).numpy()).astype(colors.dtype)
+    ### (num, views + 1) observations of every view in every cluster
+    views = batch_sign.cpu().long()
+    hits = torch.zeros((num, int(views.max()) + 1), dtype=torch.long)
+    hits.index_put_((inverse, views), torch.ones_like(views), accumulate=True)
+    view_count = (hits > 0).sum(dim=1)
+    return points_mean.to(points.device), features_mean, colors_mean, hits.argmax(dim=1).to(batch_sign), view_count
+
+def fuse_views(points:torch.Tensor, features:torch.Tensor, colors:np.ndarray, batch_sign:torch.Tensor, voxel_size:float=0.005):
+    """merge the observations of all the views into voxels, see average_clusters
+
+    Args:
+        points (torch.Tensor): (n, 3) (m)
+        features (torch.Tensor): (n, F)
+        colors (np.ndarray): (n, 3)
+        batch_sign (torch.Tensor): (n, ) (from 1)
+        voxel_size (float, optional): (m). Defaults to 0.005.
+
+    Returns:
+        points: (m, 3), features: (m, F), colors: (m, 3), batch_sign: (m, ), view_count: (m, )
+    """
+    _, inverse = torch.unique(torch.floor(points / voxel_size).long(), dim=0, return_inverse=True)
+    return average_clusters(inverse, points, features, colors, batch_sign)
+
+def farthest_point_sample(points:torch.Tensor, num:int)->torch.Tensor:
+    """greedy farthest point sampling, starting from the first point
+
+    Returns:
+        index: (num, ) torch.Tensor
+    """
+    index = torch.zeros(num, dtype=torch.long, device=points.device)
+    min_dis = torch.full((points.shape[0], ), float('inf'), device=points.device)
+    for i in range(1, num):
+        min_dis = torch.minimum(min_dis, ((points - points[index[i - 1]]) ** 2).sum(dim=-1))
+        index[i] = torch.argmax(min_dis)
+    return index
+
+def downsample_to_budget(points:torch.Tensor, features:torch.Tensor, colors:np.ndarray, batch_sign:torch.Tensor, max_points:int,
+                         method='voxel', iterations=20, chunk_size=4096):
+    """downsample a field to at most `max_points` points, the features of the merged points are averaged
+
+    'voxel' bisects the voxel size of a voxel grid until the occupied voxels fit the budget.
+    'fps' picks `max_points` centers by farthest point sampling and averages every point into its nearest center.
+
+    Args:
+        points (torch.Tensor): (num, 3)
+        features (torch.Tensor): (num, F)
+        colors (np.ndarray): (num, 3)
+        batch_sign (torch.Tensor): (num, ) (from 1)
+        max_points (int): the point budget
+        method (str, optional): 'voxel' or 'fps'. Defaults to 'voxel'.
+        iterations (int, optional): bisection steps of the voxel size. Defaults to 20.
+        chunk_size (int, optional): points per chunk of the nearest center search of 'fps'. Defaults to 4096.
+
+    Returns:
+        points: (m, 3), features: (m, F), colors: (m, 3), batch_sign: (m, )
+        inverse: (num, ) the downsampled point of every input point
+    """
+    if points.shape[0] <= max_points:
+        return points, features, colors, batch_sign, torch.arange(points.shape[0])
+    if method == 'voxel':
+        def voxelize(voxel_size):
+            return torch.unique(torch.floor(points / voxel_size).long(), dim=0, return_inverse=True)[1]
+        ### the whole field in one voxel fits any budget
+        lower, upper = 0., float((points.max(dim=0)[0] - points.min(dim=0)[0]).max()) * 2 + 1e-6
+        inverse = voxelize(upper)
+        for _ in range(iterations):
+            voxel_size = (lower + upper) / 2
+            candidate = voxelize(voxel_size)
+            if int(candidate.max()) + 1 <= max_points:
+                upper, inverse = voxel_size, candidate
+            else:
+                lower = voxel_size
+        points, features, colors, batch_sign, _ = average_clusters(inverse, points, features, colors, batch_sign)
+    elif method == 'fps':
+        centers = points[farthest_point_sample(points, max_points)]
+        inverse = torch.cat([torch.cdist(chunk.float(), centers.float()).argmin(dim=1) for chunk in torch.split(points, chunk_size)])
+        ### a duplicated center collects no point
+        used, inverse = torch.unique(inverse, return_inverse=True)
+        _, features, colors, batch_sign, _ = average_clusters(inverse, points, features, colors, batch_sign)
+        ### the centers are kept as the positions
+        points = centers[used]
+    else:
+        raise NotImplementedError
+    return points, features, colors, batch_sign, inverse.cpu()
+
+class IncrementalVote3D:
+    """vote_3D kept up to date while the points of single views are appended or removed
+
+    Every point votes for its nearest point of the other views within `dis_threshold`. The target and the distance of
+    every vote are kept, so appending a view only searches between the new view and the rest, and removing a view only
+    searches again for the points which voted into it. Unlike vote_3D, a point without any neighbour does not vote.
+    """
+
+    def __init__(self, dis_threshold=0.1, chunk_size=4096, device='cpu'):
+        self.dis_threshold = dis_threshold
+        self.chunk_size = chunk_size
+        self.device = device
+        self.points = torch.zeros((0, 3), device=device)
+        self.batch_sign = torch.zeros((0, ), dtype=torch.long, device=device)
+        ### (num, ) the voted point (-1 for no vote) and its distance
+        self.target = torch.zeros((0, ), dtype=torch.long, device=device)
+        self.target_dis = torch.zeros((0, ), device=device)
+
+    def nearest(self, query:torch.Tensor, query_sign:torch.Tensor, points:torch.Tensor, sign:torch.Tensor):
+        """the nearest point of another view within dis_threshold for every query, (-1, inf) if there is none"""
+        min_dis_ls, min_index_ls = [], []
+        for i in range(0, query.shape[0], self.chunk_size):
+            dis = torch.cdist(query[i:i + self.chunk_size], points)
+            dis[(dis > self.dis_threshold) | (query_sign[i:i + self.chunk_size, None] == sign[None, :])] = float('inf')
+            if points.shape[0] == 0:
+                min_dis = torch.full((dis.shape[0], ), float('inf'), device=self.device)
+                min_index = torch.zeros((dis.shape[0], ), dtype=torch.long, device=self.device)
+            else:
+                min_dis, min_index = torch.min(dis, dim=1)
+            min_dis_ls.append(min_dis)
+            min_index_ls.append(min_index)
+        min_dis = torch.cat(min_dis_ls) if min_dis_ls else torch.zeros((0, ), device=self.device)
+        min_index = torch.cat(min_index_ls) if min_index_ls else torch.zeros((0, ), dtype=torch.long, device=self.device)
+        min_index[torch.isinf(min_dis)] = -1
+        return min_dis, min_index
+
+    def append(self, points:torch.Tensor, batch_sign:int):
+        """append the points of one view, they go after the current points
+
+        Args:
+            points (torch.Tensor): (num', 3)
+            batch_sign (int): the view (from 1), must not be in the votes already
+        """
+        points = points.to(self.device).to(torch.float32)
+        sign = torch.full((points.shape[0], ), batch_sign, dtype=torch.long, device=self.device)
+        offset = self.points.shape[0]
+        ### the votes of the new view
+        new_dis, new_target = self.nearest(points, sign, self.points, self.batch_sign)
+        ### the old points may find a closer friend in the new view, ties keep the earlier point like vote_3D
+        old_dis, old_target = self.nearest(self.points, self.batch_sign, points, sign)
+        closer = old_dis < self.target_dis
+        self.target = torch.where(closer, old_target + offset, self.target)
+        self.target_dis = torch.where(closer, old_dis, self.target_dis)
+
+        self.points = torch.cat([self.points, points])
+        self.batch_sign = torch.cat([self.batch_sign, sign])
+        self.target = torch.cat([self.target, new_target])
+        self.target_dis = torch.cat([self.target_dis, new_dis])
+
+    def remove(self, batch_sign:int)->torch.Tensor:
+        """remove the points of one view
+
+        Returns:
+            keep: (num, ) torch.Tensor bool, the points kept from before the removal
+        """
+        keep = self.batch_sign != batch_sign
+        ### the new index of every kept point
+        remap = torch.cumsum(keep.long(), dim=0) - 1
+        ### the points which voted into the removed view have to vote again
+        orphan = (self.target >= 0) & ~keep[self.target.clamp_min(0)]
+        target = torch.where((self.target < 0) | orphan, -1, remap[self.target.clamp_min(0)])
+        self.points, self.batch_sign = self.points[keep], self.batch_sign[keep]
+        self.target, self.target_dis = target[keep], self.target_dis[keep]
+        orphan = orphan[keep]
+        if orphan.any():
+            dis, index = self.nearest(self.points[orphan], self.batch_sign[orphan], self.points, self.batch_sign)
+            self.target[orphan], self.target_dis[orphan] = index, dis
+        return keep
+
+    def get_ballot(self)->torch.Tensor:
+        """(num, ) the votes received by every point"""
+        voted = self.target[self.target >= 0]
+        return torch.bincount(voted, minlength=self.points.shape[0])
+
+    def select(self, selected_num:int)->torch.Tensor:
+        """the marker of the `selected_num` most voted points, as vote_3D
+
+        Returns:
+            marker: (num, ) torch.Tensor bool
+        """
+        sort_index = torch.argsort(self.get_ballot(), descending=True)
+        marker = torch.zeros(self.points.shape[0], dtype=torch.bool, device=self.device)
+        marker[sort_index[:selected_num]] = True
+        return marker
@@ -25,6 +25,7 @@ from pytorch3d.renderer import (
   
 )
 import skimage
+from camera.dino import get_dino_model, get_default_device
 
 def pt_vis(points:np.ndarray, size=None):
     """vicsualize the point cloud"""
@@ -472,28 +473,29 @@ def get_matched_pt_ft(imgs:torch.Tensor, depths:torch.Tensor, points:torch.Tenso
         match_features.append(match_feature)
     return torch.cat(match_points, dim=0), torch.cat(match_features, dim=0)
 
-def get_dino_features(img_raw:np.ndarray, scale:int=3)->torch.Tensor:
+def get_dino_features(img_raw:np.ndarray, scale:int=3, device=None)->torch.Tensor:
     """get dino features for only one img
 
     Args:
         img (np.ndarray): (h, w, 3)
         scale (int, optional): _description_. Defaults to 3.
+        device (optional): Defaults to None(cuda if available, else cpu).
 
     Returns:
         torch.Tensor: (h, w, F)
     """
     img_raw = img_raw.astype('float32') / 255.
     img_raw = skimage.img_as_float32(img_raw)
-    torch.hub.set_dir( "./")
-    model = torch.hub.load('./thirdparty_module/dinov2', 'dinov2_vitb14', source='local', pretrained=False).cuda()
-    model.load_state_dict(torch.load('./thirdparty_module/dinov2_vitb14_pretrain.pth'))
+    ### loaded once per process, see camera.dino.release_dino_models
+    device = device or get_default_device()
+    model = get_dino_model(device)
     h, w = img_raw.shape[0] // 14 * 14,  img_raw.shape[1] // 14 * 14
     img = skimage.transform.resize(
                 img_raw,
                 (img_raw.shape[0] // 14 * 14 , img_raw.shape[1] // 14 * 14 )
             ).astype('float32')
     img = torch.from_numpy(img)
-    img = img[None, :].cuda()
+    img = img[None, :].to(device)
     # print('Picture for Dino size:', img.shape)
     with torch.no_grad():
         ### (batch size, 3, height, width)
@@ -5,13 +5,16 @@ from torch.utils.data import Dataset, DataLoader
 
 class home_made_feature_interpolator:
 
-    def __init__(self, points:np.ndarray, features:np.ndarray, device = None) -> None:
+    def __init__(self, points:np.ndarray, features:np.ndarray, device = None, max_bytes:int = None, chunk_size:int = None) -> None:
         """Initialize the interpolator
 
         Args:
             points (np.ndarray): (n, 3)
             features (np.ndarray): (n, dim)
             device (_type_, optional): the device used for torch. Defaults to None(auto-detect).
+            max_bytes (int, optional): memory budget of one (query, field point) tile. Defaults to None(no tiling).
+            chunk_size (int, optional): number of field points (and queries, if max_bytes is None) per tile.
+                Defaults to None(no tiling).
         """
         if device:
             self.dev = torch.device(device)
@@ -21,6 +24,8 @@ class home_made_feature_interpolator:
             else:
                 self.dev = torch.device('cpu')
         self.sigma = 0.01
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
         self.points = torch.from_numpy(points).to(torch.float32).to(self.dev)
         print('points_mean:', self.points.mean(dim=0))
         # self.points = self.points - self.points.mean(dim=0)
@@ -45,11 +50,34 @@ class home_made_feature_interpolator:
         num_points = self.points.shape[0]
         num_query_points = query_points.shape[0]
         # show_pc(self.points.cpu().detach().numpy(), query_points.cpu().detach().numpy())
+        if self.features.isnan().any():
+            raise ValueError('nan in self.features')
+        if self.max_bytes is None and self.chunk_size is None:
+            weights = self.get_weights(query_points, self.points)
+            # 对每个query_point，计算其特征的加权平均，shape为(num_query_points, num_features)
+            interpolated_features = torch.mm(weights, self.features) / torch.sum(weights, dim=1, keepdim=True)
+        else:
+            # 分块累加加权特征(分子)和权重(分母)，不保存完整的(num_query_points, num_points)矩阵
+            query_chunk, point_chunk = self.get_tile_sizes(num_query_points)
+            interpolated_ls = []
+            for i in range(0, num_query_points, query_chunk):
+                query = query_points[i:i + query_chunk]
+                numerator, denominator = 0, 0
+                for j in range(0, num_points, point_chunk):
+                    weights = self.get_weights(query, self.points[j:j + point_chunk])
+                    numerator = numerator + torch.mm(weights, self.features[j:j + point_chunk])
+                    denominator = denominator + torch.sum(weights, dim=1, keepdim=True)
+                interpolated_ls.append(numerator / denominator)
+            interpolated_features = torch.cat(interpolated_ls, dim=0)
+        if interpolated_features.isnan().any():
+            raise ValueError('nan in interpolated_features')
         
+        return interpolated_features.reshape(b, n, -1)
+
+    def get_weights(self, query_points:torch.Tensor, points:torch.Tensor)->torch.Tensor:
+        """inverse distance weights between the queries (q, 3) and the field points (p, 3), shape (q, p)"""
         # 扩展points和query_points，使其shape变为(num_query_points, num_points, dim)
-        # points_exp = self.points.unsqueeze(0).repeat((num_query_points, 1, 1))
-        # query_points_exp = query_points.unsqueeze(1).repeat((1, num_points, 1))
-        points_exp = self.points[None, :, :]
+        points_exp = points[None, :, :]
         query_points_exp = query_points[:, None, :]
         
         # 计算query_points和points之间的欧氏距离，shape为(num_query_points, num_points)
@@ -64,16 +92,21 @@ class home_made_feature_interpolator:
         weights = 1 / (dists + 1e-10)**2
         if weights.isnan().any():
             raise ValueError('nan in weights')
-        
-        # 对每个query_point，计算其特征的加权平均，shape为(num_query_points, num_features)
-        # print(weights.dtype, self.features.dtype)
-        if self.features.isnan().any():
-            raise ValueError('nan in self.features')
-        interpolated_features = torch.mm(weights, self.features) / torch.sum(weights, dim=1, keepdim=True)
-        if interpolated_features.isnan().any():
-            raise ValueError('nan in interpolated_features')
-        
-        return interpolated_features.reshape(b, n, -1)
+        return weights
+
+    def get_tile_sizes(self, num_query_points:int):
+        """the (query, field point) tile shape that fits max_bytes
+
+        Every pair of a tile keeps the difference vector, the distance and the weight alive.
+        """
+        num_points = self.points.shape[0]
+        if self.max_bytes is None:
+            point_chunk = min(self.chunk_size, num_points)
+            return min(self.chunk_size, num_query_points), point_chunk
+        pair_budget = max(1, self.max_bytes // ((self.points.shape[1] + 2) * self.points.element_size()))
+        point_chunk = min(self.chunk_size or pair_budget, num_points)
+        query_chunk = max(1, pair_budget // point_chunk)
+        return min(query_chunk, num_query_points), point_chunk
 
 # MHA Try
 import torch.nn as nn
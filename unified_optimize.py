@@ -3,22 +3,63 @@ import numpy as np
 import time
 import random
 import argparse
-from prune import get_points_features_from_real
+from prune import get_points_features_from_real, fit_projection, project_features, save_projection, load_projection, \
+    hash_field_inputs, get_incremental_field_from_real, load_views, load_feature_field, load_points_features_from_field, \
+    get_workspace_points
 from optimize.alignment import Hand_AlignmentCheck, Gripper_AlignmentCheck
+from camera.dino import checkpoint_fingerprint
 import os
+import json
+import hashlib
 from omegaconf import DictConfig, OmegaConf, open_dict
+from scipy.spatial import cKDTree
+from optimize.feature_field import VoxelFeatureGrid, HashFeatureGrid, IDWFunction, FeatureOctree, FEATURE_DTYPES,\
+    quantize_features, dequantize_features
 from pyvirtualdisplay import Display
 import pyglet
 
 class home_made_feature_interpolator:
 
-    def __init__(self, points:np.ndarray, features:np.ndarray, device = None) -> None:
+    def __init__(self, points:np.ndarray, features:np.ndarray, device = None, mode:str = 'dense', k:int = 32,
+                 max_bytes:int = None, chunk_size:int = None, grid_voxel_size:float = 0.005, grid_bounds = None,
+                 grid_padding:float = 0.05, hash_voxel_size:float = 0.002, hash_dilation:int = 2, tree:cKDTree = None,
+                 lean_backward:bool = False, octree_theta:float = 0.5, octree_leaf_size:int = 32,
+                 knn_skin:float = None, feature_dtype:str = 'float32', feature_scale:np.ndarray = None) -> None:
         """Initialize the interpolator
 
         Args:
             points (np.ndarray): (n, 3)
             features (np.ndarray): (n, dim)
             device (_type_, optional): the device used for torch. Defaults to None(auto-detect).
+            feature_dtype (str, optional): storage of the features, 'float32', 'float16', 'bfloat16' or 'int8'.
+                They are dequantized tile by tile inside the interpolation, the 'dense' mode streams over
+                chunks of field points even without max_bytes and chunk_size. Defaults to 'float32'.
+            feature_scale (np.ndarray, optional): (dim, ) the per-channel scale, if `features` are already int8.
+                Defaults to None.
+            mode (str, optional): 'dense' weights every field point for every query,
+                'knn' only weights the k nearest field points (found with a KD-tree built once here),
+                'grid' bakes the field into a voxel grid once and samples it trilinearly,
+                'hash_grid' bakes it only into the voxels near the points (a sparse hash grid),
+                'octree' approximates distant clusters of points as single pseudo-points (Barnes-Hut). Defaults to 'dense'.
+            k (int, optional): the number of neighbours used in the 'knn' mode. Defaults to 32.
+            max_bytes (int, optional): memory budget of one (query, field point) tile in the 'dense' mode.
+                Defaults to None(no tiling).
+            chunk_size (int, optional): number of field points (and queries, if max_bytes is None) per tile.
+                Defaults to None(no tiling).
+            grid_voxel_size (float, optional): voxel size (m) of the 'grid' mode. Defaults to 0.005.
+            grid_bounds (list, optional): [[x_min, y_min, z_min], [x_max, y_max, z_max]] of the 'grid' mode.
+                Defaults to None(the bounding box of the points enlarged by grid_padding).
+            grid_padding (float, optional): Defaults to 0.05.
+            hash_voxel_size (float, optional): voxel size (m) of the 'hash_grid' mode. Defaults to 0.002.
+            hash_dilation (int, optional): voxel rings allocated around the points in the 'hash_grid' mode. Defaults to 2.
+            tree (cKDTree, optional): a prebuilt KD-tree over the points for the 'knn' mode. Defaults to None(build one).
+            lean_backward (bool, optional): under autograd, use IDWFunction for the dense interpolation, which recomputes
+                the weights tile by tile in the backward instead of keeping the full weight matrix. Defaults to False.
+            octree_theta (float, optional): accuracy parameter of the 'octree' mode, 0 is exact. Defaults to 0.5.
+            octree_leaf_size (int, optional): maximum number of points in a leaf of the 'octree' mode. Defaults to 32.
+            knn_skin (float, optional): skin radius (m) of the Verlet neighbour lists of the 'knn' mode. Every query keeps
+                the candidates within (its k-th neighbour distance + skin), which are only searched again once it moved
+                more than half the skin. Defaults to None(search from scratch on every call).
         """
         if device:
             self.dev = torch.device(device)
@@ -28,11 +69,105 @@ class home_made_feature_interpolator:
             else:
                 self.dev = torch.device('cpu')
         self.sigma = 0.01
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.lean_backward = lean_backward
         self.points = torch.from_numpy(points).to(torch.float32).to(self.dev)
-        self.features = torch.from_numpy(features).to(torch.float32).to(self.dev)
-    
+        features = torch.as_tensor(features).to(self.dev)
+        if features.dtype == FEATURE_DTYPES[feature_dtype] and feature_dtype != 'float32':
+            ### already stored in reduced precision (e.g. from a feature field package)
+            self.features = features
+            self.feature_scale = None if feature_scale is None else torch.as_tensor(feature_scale).to(self.dev)
+        else:
+            self.features, self.feature_scale = quantize_features(features.to(torch.float32), feature_dtype)
+        self.max_k, self.knn_skin = k, knn_skin
+        self.grid_conf = {'grid_voxel_size': grid_voxel_size, 'grid_bounds': grid_bounds, 'grid_padding': grid_padding,
+                          'hash_voxel_size': hash_voxel_size, 'hash_dilation': hash_dilation}
+        self.octree_theta, self.octree_leaf_size = octree_theta, octree_leaf_size
+        self.build_index(tree)
+
+    def build_index(self, tree:cKDTree = None):
+        """build the acceleration structure of the mode over the current field points
+
+        Args:
+            tree (cKDTree, optional): a prebuilt KD-tree over the points for the 'knn' mode. Defaults to None(build one).
+        """
+        points = self.points.cpu().numpy()
+        if self.mode == 'knn':
+            self.k = min(self.max_k, points.shape[0])
+            self.tree = tree if tree is not None else cKDTree(points)
+            self.skin = self.knn_skin
+            ### a sentinel point at infinity pads the candidate lists
+            self.points_pad = torch.cat([self.points, torch.full((1, 3), float('inf'), device=self.dev)], dim=0)
+            self.verlet_anchor, self.verlet_candidates = None, None
+            self.verlet_calls, self.verlet_rebuilds, self.verlet_queries = 0, 0, 0
+        elif self.mode in ['grid', 'hash_grid']:
+            ### bake with tiles of about 256MB if no budget is given
+            batch_size = max(1, (self.max_bytes or 1 << 28) // (5 * 4 * points.shape[0]))
+            if self.mode == 'grid':
+                self.grid = VoxelFeatureGrid(self.predict_dense, self.points, voxel_size=self.grid_conf['grid_voxel_size'],
+                                             bounds=self.grid_conf['grid_bounds'], padding=self.grid_conf['grid_padding'],
+                                             batch_size=batch_size)
+            else:
+                self.grid = HashFeatureGrid(self.predict_dense, self.points, voxel_size=self.grid_conf['hash_voxel_size'],
+                                            dilation=self.grid_conf['hash_dilation'], batch_size=batch_size)
+        elif self.mode == 'octree':
+            self.octree = FeatureOctree(self.points, dequantize_features(self.features, self.feature_scale), theta=self.octree_theta,
+                                        leaf_size=self.octree_leaf_size, max_bytes=self.max_bytes or 1 << 26, predict_fn=self.predict_dense)
+        elif self.mode != 'dense':
+            raise NotImplementedError
+
+    def append_points(self, points:np.ndarray, features:np.ndarray):
+        """add field points, e.g. of a new camera view
+
+        The dense modes need no update, the KD-tree of the 'knn' mode is rebuilt (its Verlet lists are dropped),
+        the 'grid', 'hash_grid' and 'octree' modes are baked again since every IDW value depends on all the points.
+
+        Args:
+            points (np.ndarray): (m, 3)
+            features (np.ndarray): (m, dim) float
+        """
+        features = torch.as_tensor(features).to(self.dev).to(torch.float32)
+        if self.feature_scale is not None:
+            ### int8: widen the scale of the channels the new features overflow, and requantize the old features
+            scale = torch.maximum(self.feature_scale, features.abs().max(dim=0)[0] / 127)
+            if (scale > self.feature_scale).any():
+                self.features, _ = quantize_features(self.get_features(), 'int8', scale=scale)
+                self.feature_scale = scale
+            features, _ = quantize_features(features, 'int8', scale=self.feature_scale)
+        else:
+            features = features.to(self.features.dtype)
+        self.points = torch.cat([self.points, torch.from_numpy(points).to(torch.float32).to(self.dev)], dim=0)
+        self.features = torch.cat([self.features, features], dim=0)
+        self.build_index()
+
+    def remove_points(self, mask:np.ndarray):
+        """remove the field points selected by the (n, ) boolean mask, see append_points for the update of the modes"""
+        keep = ~torch.as_tensor(mask, dtype=torch.bool, device=self.dev)
+        self.points, self.features = self.points[keep], self.features[keep]
+        self.build_index()
+
+    @classmethod
+    def from_field(cls, field, device = None, **kwargs):
+        """build the interpolator from a memory-mapped feature field package (see prune.load_feature_field)
+
+        On the cpu the tensors share the mapped pages, and the 'knn' mode reuses the KD-tree of the field.
+        """
+        if kwargs.get('mode') == 'knn':
+            kwargs.setdefault('tree', field.tree)
+        if kwargs.get('feature_dtype', 'float32') == field.feature_dtype:
+            ### keep the stored precision, no float copy of the features
+            kwargs['feature_scale'] = field.feature_scale
+            return cls(field.points, field.get_stored_features(), device=device, **kwargs)
+        return cls(field.points, field.get_features(), device=device, **kwargs)
+
     def get_points(self)->np.ndarray:
         return self.points.cpu().numpy()
+
+    def get_features(self, index = slice(None))->torch.Tensor:
+        """the float32 features of the field points selected by index, dequantized on the fly"""
+        return dequantize_features(self.features[index], self.feature_scale)
     
     def predict(self, query_points:torch.Tensor)->torch.Tensor:
         """
@@ -47,7 +182,128 @@ class home_made_feature_interpolator:
         dim = self.points.shape[1]
         b, n, _ = query_points.shape
         query_points = query_points.reshape(-1, dim)
-        points_exp = self.points[None, :, :]
+        if self.features.isnan().any():
+            raise ValueError('nan in self.features')
+        if self.mode == 'knn':
+            interpolated_features = self.predict_knn(query_points)
+        elif self.mode in ['grid', 'hash_grid']:
+            interpolated_features = self.predict_grid(query_points)
+        elif self.mode == 'octree':
+            interpolated_features = self.octree.predict(query_points)
+        else:
+            interpolated_features = self.predict_dense(query_points)
+        if interpolated_features.isnan().any():
+            raise ValueError('nan in interpolated_features')
+        
+        return interpolated_features.reshape(b, n, -1)
+
+    def predict_dense(self, query_points:torch.Tensor)->torch.Tensor:
+        """inverse distance weighting over all the field points
+
+        If max_bytes or chunk_size is set, the queries and the field points are streamed in tiles and
+        only the weighted-feature numerator and the weight denominator are accumulated,
+        so the full (num_query_points, num_points) matrix is never held.
+
+        Args:
+            query_points (torch.Tensor): (num_query_points, 3)
+
+        Returns:
+            torch.Tensor: (num_query_points, dim)
+        """
+        if self.lean_backward and query_points.requires_grad:
+            ### the backward recomputes the pairs by tiles, by default of 256MB as the grid baking
+            query_chunk, point_chunk = self.get_tile_sizes(query_points.shape[0], default_bytes=1 << 28)
+            return IDWFunction.apply(query_points, self.points, self.features, self.feature_scale, query_chunk, point_chunk)
+        if self.max_bytes is None and self.chunk_size is None and self.features.dtype == torch.float32:
+            weights = self.get_weights(query_points, self.points)
+            return torch.mm(weights, self.features) / torch.sum(weights, dim=1, keepdim=True)
+
+        query_chunk, point_chunk = self.get_tile_sizes(query_points.shape[0])
+        interpolated_ls = []
+        for i in range(0, query_points.shape[0], query_chunk):
+            query = query_points[i:i + query_chunk]
+            numerator, denominator = 0, 0
+            for j in range(0, self.points.shape[0], point_chunk):
+                weights = self.get_weights(query, self.points[j:j + point_chunk])
+                ### only the features of the tile are converted, the int8 scale is applied to the (q, dim) result
+                numerator = numerator + torch.mm(weights, self.features[j:j + point_chunk].to(torch.float32))
+                denominator = denominator + torch.sum(weights, dim=1, keepdim=True)
+            interpolated_ls.append(numerator / denominator)
+        interpolated_features = torch.cat(interpolated_ls, dim=0)
+        return interpolated_features if self.feature_scale is None else interpolated_features * self.feature_scale
+
+    def get_verlet_neighbours(self, query_points:torch.Tensor)->torch.Tensor:
+        """the k nearest field points of every query, searched among its Verlet candidates
+
+        The queries are matched to the candidate lists by their position in query_points, which is stable
+        between the optimizer steps. A list stays exact while its query moved less than half the skin from
+        the anchor where the list was built, otherwise it is rebuilt.
+
+        Args:
+            query_points (torch.Tensor): (num_query_points, 3), detached
+
+        Returns:
+            torch.Tensor: (num_query_points, k) indices of the field points
+        """
+        num_query_points = query_points.shape[0]
+        sentinel = self.points.shape[0]
+        if self.verlet_anchor is None or self.verlet_anchor.shape[0] != num_query_points:
+            self.verlet_anchor = query_points.clone()
+            self.verlet_candidates = torch.full((num_query_points, self.k), sentinel, dtype=torch.long, device=self.dev)
+            stale = torch.ones(num_query_points, dtype=torch.bool, device=self.dev)
+        else:
+            stale = torch.norm(query_points - self.verlet_anchor, dim=-1) > self.skin / 2
+        self.verlet_calls += 1
+        self.verlet_queries += num_query_points
+        self.verlet_rebuilds += int(stale.sum())
+
+        if stale.any():
+            anchor = query_points[stale].cpu().numpy()
+            dists, _ = self.tree.query(anchor, k=self.k)
+            radius = dists.reshape(anchor.shape[0], self.k)[:, -1] + self.skin
+            balls = self.tree.query_ball_point(anchor, radius)
+            width = max(self.verlet_candidates.shape[1], max(len(ball) for ball in balls))
+            table = np.full((anchor.shape[0], width), sentinel, dtype=np.int64)
+            for i, ball in enumerate(balls):
+                table[i, :len(ball)] = ball
+            if width > self.verlet_candidates.shape[1]:
+                padding = torch.full((num_query_points, width - self.verlet_candidates.shape[1]), sentinel,
+                                     dtype=torch.long, device=self.dev)
+                self.verlet_candidates = torch.cat([self.verlet_candidates, padding], dim=1)
+            self.verlet_candidates[stale] = torch.from_numpy(table).to(self.dev)
+            self.verlet_anchor[stale] = query_points[stale]
+
+        candidate_dists = torch.norm(self.points_pad[self.verlet_candidates] - query_points[:, None, :], dim=-1)
+        _, nearest = torch.topk(candidate_dists, self.k, dim=1, largest=False)
+        return torch.gather(self.verlet_candidates, 1, nearest)
+
+    def get_verlet_stats(self)->dict:
+        """counters of the Verlet neighbour lists"""
+        return {'calls': self.verlet_calls, 'rebuilt_queries': self.verlet_rebuilds,
+                'rebuild_rate': self.verlet_rebuilds / max(1, self.verlet_queries)}
+
+    def predict_grid(self, query_points:torch.Tensor)->torch.Tensor:
+        """trilinear lookup in the baked (hash) grid, the queries outside of it fall back to predict_dense
+
+        Args:
+            query_points (torch.Tensor): (num_query_points, 3)
+
+        Returns:
+            torch.Tensor: (num_query_points, dim)
+        """
+        if self.mode == 'grid':
+            interpolated_features = self.grid.sample(query_points)
+            outside = ~self.grid.contains(query_points)
+        else:
+            interpolated_features, found = self.grid.sample(query_points)
+            outside = ~found
+        if outside.any():
+            interpolated_features = interpolated_features.index_put((outside, ), self.predict_dense(query_points[outside]))
+        return interpolated_features
+
+    def get_weights(self, query_points:torch.Tensor, points:torch.Tensor)->torch.Tensor:
+        """inverse distance weights between the queries (q, 3) and the field points (p, 3), shape (q, p)"""
+        points_exp = points[None, :, :]
         query_points_exp = query_points[:, None, :]
         
         dists = torch.norm((points_exp - query_points_exp), dim=-1)
@@ -57,72 +313,352 @@ class home_made_feature_interpolator:
         weights = 1 / (dists + 1e-10)**2
         if weights.isnan().any():
             raise ValueError('nan in weights')
-        if self.features.isnan().any():
-            raise ValueError('nan in self.features')
-        interpolated_features = torch.mm(weights, self.features) / torch.sum(weights, dim=1, keepdim=True)
-        if interpolated_features.isnan().any():
-            raise ValueError('nan in interpolated_features')
-        
-        return interpolated_features.reshape(b, n, -1)
+        return weights
+
+    def get_tile_sizes(self, num_query_points:int, default_bytes:int=None):
+        """the (query, field point) tile shape that fits max_bytes
+
+        Every pair of a tile keeps the difference vector, the distance and the weight alive.
+
+        Args:
+            default_bytes (int, optional): the budget used when neither max_bytes nor chunk_size is set.
+                Defaults to None(a single tile).
+        """
+        num_points = self.points.shape[0]
+        max_bytes = self.max_bytes
+        if max_bytes is None and self.chunk_size is None:
+            if default_bytes is None:
+                if self.features.dtype == torch.float32:
+                    return num_query_points, num_points
+                ### reduced precision features are converted by chunks of about 64MB
+                return num_query_points, min(num_points, max(1, (1 << 26) // (4 * self.features.shape[1])))
+            max_bytes = default_bytes
+        if max_bytes is None:
+            point_chunk = min(self.chunk_size, num_points)
+            return min(self.chunk_size, num_query_points), point_chunk
+        pair_budget = max(1, max_bytes // ((self.points.shape[1] + 2) * self.points.element_size()))
+        point_chunk = min(self.chunk_size or pair_budget, num_points)
+        query_chunk = max(1, pair_budget // point_chunk)
+        return min(query_chunk, num_query_points), point_chunk
+
+    def predict_knn(self, query_points:torch.Tensor)->torch.Tensor:
+        """inverse distance weighting over the k nearest field points, O(num_query_points * k)
+
+        The neighbour search runs on the detached queries, but the distances are
+        recomputed in torch so the gradients still flow to the query points.
+
+        Args:
+            query_points (torch.Tensor): (num_query_points, 3)
+
+        Returns:
+            torch.Tensor: (num_query_points, dim)
+        """
+        if self.skin is None:
+            _, index = self.tree.query(query_points.detach().cpu().numpy(), k=self.k)
+            ### (num_query_points, k)
+            index = torch.from_numpy(index.reshape(query_points.shape[0], self.k)).to(self.dev)
+        else:
+            index = self.get_verlet_neighbours(query_points.detach())
+        dists = torch.norm(self.points[index] - query_points[:, None, :], dim=-1)
+        if dists.isnan().any():
+            raise ValueError('nan in dists')
+
+        weights = 1 / (dists + 1e-10)**2
+        return torch.einsum('qk,qkf->qf', weights, self.get_features(index)) / torch.sum(weights, dim=1, keepdim=True)
+
 class Dino_Processor:
     def __init__(self, conf, name, mode) -> None:
         self.conf = conf
         seed = conf.seed
         self.name = name
         self.mode = mode
-        np.random.seed(seed)
-        random.seed(seed)
-        torch.random.manual_seed(seed)
+        self.seed()
         if conf.device:
             self.device = torch.device(conf.device)
         else:
             self.device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
 
-        points1, features1, self.color_ref1, self.points_vis1, self.color_vis1, _ = get_points_features_from_real(path=conf.data1,
-                                                            extrinsics_path=conf.extrinsics_path, key=0,
-                                                            dis_threshold=conf.dis_threshold, quotient_threshold=conf.quotient_threshold, 
-                                                            method=conf.method,verbose=conf.verbose, model_path=conf.model_path,
-                                                            scale=conf.scale, name=self.name, p0=conf.img_preprocess[0])
-        points2, features2, self.color_ref2, self.points_vis2, self.color_vis2, self.points_ref2 = get_points_features_from_real(path=conf.data2, 
-                                                               extrinsics_path=conf.extrinsics_path, key=1, 
-                                                               dis_threshold=conf.dis_threshold, quotient_threshold=conf.quotient_threshold, 
-                                                               method=conf.method, verbose=conf.verbose, model_path=conf.model_path,
-                                                               scale=conf.scale, name=self.name, p1=conf.img_preprocess[1])
+        self.interpolator_conf = OmegaConf.to_container(conf.interpolator)
+        self.dino_conf = OmegaConf.to_container(conf.dino)
+        ### the packages of the fields are reused while their inputs do not change
+        self.field_hashes = [self.hash_field(0), self.hash_field(1)]
+        ### the reference field is only built on a miss of the descriptor cache
+        self.field_hash = None
+        if conf.alignment.descriptor_cache:
+            if conf.projection.method:
+                print('the descriptor cache is disabled, the projection depends on the test field')
+            elif self.field_hashes[0] is None:
+                print('the descriptor cache is disabled, the reference is captured live')
+            else:
+                self.field_hash = hashlib.sha1(json.dumps({'field': self.field_hashes[0], 'interpolator': self.interpolator_conf},
+                                                          sort_keys=True).encode('utf-8')).hexdigest()
+        self.field1 = self.points1 = self.features1 = self.color_ref1 = self.points_vis1 = self.color_vis1 = self.interpolator1 = None
+        if self.field_hash is None:
+            self.load_reference_field()
+
+        if conf.field.incremental:
+            ### the test field accepts new captures of single cameras, see update_view
+            if conf.method != 'vote_3D' or conf.field.fuse_voxel_size or conf.field.max_points or conf.projection.method:
+                raise NotImplementedError
+            self.field2, self.points_ref2 = get_incremental_field_from_real(path=conf.data2, extrinsics_path=conf.extrinsics_path, key=1,
+                                                                            dis_threshold=conf.dis_threshold, verbose=conf.verbose,
+                                                                            model_path=conf.model_path, scale=conf.scale, name=self.name,
+                                                                            prune_method=conf.img_preprocess[1], dino_conf=self.dino_conf)
+            self.points2, self.features2, self.color_ref2 = self.field2.get_synced()
+            self.points_vis2, self.color_vis2 = self.field2.points.cpu().numpy(), self.field2.colors
+        else:
+            self.field2 = self.load_field(1)
+            self.points2, self.features2, self.color_ref2 = self.field2.points, self.field2.get_features(), self.field2.colors
+            self.points_vis2, self.color_vis2 = self.field2.arrays['points_vis'], self.field2.arrays['colors_vis']
+            self.points_ref2 = self.field2.arrays['points_ref']
 
-        self.points1, self.features1 = points1.cpu().numpy(), features1.cpu().numpy()
-        self.points2, self.features2 = points2.cpu().numpy(), features2.cpu().numpy()
+        if conf.projection.method:
+            features_full1, features_full2 = self.features1, self.features2
+            ### fitted on both fields, reused while neither of them nor the projection changes
+            projection_hash = None
+            if None not in self.field_hashes:
+                projection_hash = hashlib.sha1(json.dumps({'fields': self.field_hashes, 'projection': OmegaConf.to_container(conf.projection)},
+                                                          sort_keys=True).encode('utf-8')).hexdigest()
+            projection_path = './data/projection.npz'
+            projection = load_projection(projection_path, projection_hash) if projection_hash else None
+            if projection is None:
+                self.proj_mean, self.proj_matrix = fit_projection([self.features1, self.features2], dim=conf.projection.dim,
+                                                                  method=conf.projection.method, seed=seed)
+                save_projection(projection_path, self.proj_mean, self.proj_matrix, conf.projection.method, projection_hash)
+            else:
+                self.proj_mean, self.proj_matrix, _ = projection
+            self.features1 = project_features(self.features1, self.proj_mean, self.proj_matrix)
+            self.features2 = project_features(self.features2, self.proj_mean, self.proj_matrix)
+            if conf.verbose:
+                self.report_projection(features_full1, features_full2)
 
         if conf.verbose:
-            print('points1: ', self.points1.shape)
+            if self.points1 is not None:
+                print('points1: ', self.points1.shape)
             print('points2: ', self.points2.shape)
-            print('features1: ', self.features1.shape)
+            if self.features1 is not None:
+                print('features1: ', self.features1.shape)
             print('features2: ', self.features2.shape)
-        self.interpolator1 = home_made_feature_interpolator(self.points1, self.features1)
-        self.interpolator2 = home_made_feature_interpolator(self.points2, self.features2)
+        if self.field_hash is None:
+            self.interpolator1 = self.get_interpolator(self.field1, self.points1, self.features1)
+        self.interpolator2 = self.get_interpolator(None if conf.field.incremental else self.field2, self.points2, self.features2)
     
-    def process(self):
-        
+    def hash_field(self, key:int, feature_dtype:str=None)->str:
+        """the hash of everything field `key` is built from, None if it is captured live
+
+        Args:
+            feature_dtype (str, optional): the precision of the package. Defaults to None(field.feature_dtype).
+        """
+        conf = self.conf
+        data_path = [conf.data1, conf.data2][key]
+        if not data_path:
+            return None
+        build_conf = {'seed': conf.seed, 'scale': conf.scale, 'method': conf.method, 'dis_threshold': conf.dis_threshold,
+                      'quotient_threshold': conf.quotient_threshold, 'model_path': conf.model_path,
+                      'img_preprocess': conf.img_preprocess[key], 'feature_dtype': feature_dtype or conf.field.feature_dtype,
+                      'fuse_voxel_size': conf.field.fuse_voxel_size, 'max_points': conf.field.max_points,
+                      'downsample': conf.field.downsample,
+                      ### the dino options changing the features, and the weights
+                      'dino': {option: value for option, value in self.dino_conf.items()
+                               if option not in ['cache_dir', 'num_threads', 'max_batch', 'onnx_cache_dir', 'token_cache_size']},
+                      'dino_checkpoint': checkpoint_fingerprint()}
+        return hash_field_inputs(data_path, conf.extrinsics_path, build_conf)
+
+    def load_field(self, key:int, feature_dtype:str=None):
+        """the package of field `key`, built from the captures only if there is none built from the same inputs
+
+        Args:
+            feature_dtype (str, optional): another precision than field.feature_dtype, kept in its own
+                package ./data/field_{key}_{feature_dtype}.sdff. Defaults to None.
+
+        Returns:
+            FeatureField: memory-mapped, see prune.get_points_features_from_real for its arrays
+        """
+        conf = self.conf
+        if feature_dtype is None:
+            path, field_hash = f'./data/field_{key}.sdff', self.field_hashes[key]
+        else:
+            path, field_hash = f'./data/field_{key}_{feature_dtype}.sdff', self.hash_field(key, feature_dtype)
+        field = load_points_features_from_field(path, field_hash) if field_hash else None
+        if field is not None:
+            if conf.verbose:
+                print(f'field {key} read from {path}')
+            return field
+        get_points_features_from_real(path=[conf.data1, conf.data2][key], extrinsics_path=conf.extrinsics_path, key=key,
+                                      dis_threshold=conf.dis_threshold, quotient_threshold=conf.quotient_threshold,
+                                      method=conf.method, verbose=conf.verbose, model_path=conf.model_path,
+                                      scale=conf.scale, name=self.name, p0=conf.img_preprocess[0], p1=conf.img_preprocess[1],
+                                      feature_dtype=feature_dtype or conf.field.feature_dtype,
+                                      fuse_voxel_size=conf.field.fuse_voxel_size,
+                                      max_points=conf.field.max_points, downsample=conf.field.downsample,
+                                      dino_conf=self.dino_conf, field_hash=field_hash, field_path=path)
+        ### read back, a fresh and a reused field are the same (e.g. in the package precision)
+        return load_feature_field(path)
+
+    def get_interpolator(self, field, points:np.ndarray, features:np.ndarray)->home_made_feature_interpolator:
+        """the interpolator of a field, straight from its package unless its features were changed (projected)"""
+        if field is None or self.conf.projection.method:
+            return home_made_feature_interpolator(points, features, **self.interpolator_conf)
+        return home_made_feature_interpolator.from_field(field, **self.interpolator_conf)
+
+    def load_reference_field(self):
+        self.field1 = self.load_field(0)
+        self.points1, self.features1, self.color_ref1 = self.field1.points, self.field1.get_features(), self.field1.colors
+        self.points_vis1, self.color_vis1 = self.field1.arrays['points_vis'], self.field1.arrays['colors_vis']
+
+    def build_reference(self):
+        """build the reference field and its interpolator on a miss of the descriptor cache
+
+        Returns:
+            interpolator1, points1, color_ref1
+        """
+        if self.interpolator1 is None:
+            self.load_reference_field()
+            self.interpolator1 = self.get_interpolator(self.field1, self.points1, self.features1)
+        return self.interpolator1, self.points1, self.color_ref1
+
+    def update_view(self, view:int, data_path:str = None):
+        """replace the points of one camera of the test scene (a new camera or a re-capture) without rebuilding the scene
+
+        The vote of the pruning and the test interpolator are updated incrementally, needs field.incremental.
+
+        Args:
+            view (int): index of the camera, see camera.CAM_INDEX
+            data_path (str, optional): the capture folder. Defaults to None(capture now).
+        """
+        conf = self.conf
+        if not conf.field.incremental:
+            raise NotImplementedError
+        points, features, colors, _, raw_points = load_views(data_path, conf.extrinsics_path, key=1, name=self.name, scale=conf.scale,
+                                                    verbose=conf.verbose, model_path=conf.model_path,
+                                                    prune_method=conf.img_preprocess[1], views=[view], dino_conf=self.dino_conf)
+        self.field2.add_view(points, features, colors, view + 1)
+        removed, added = self.field2.sync(self.interpolator2)
+        self.points2, self.features2, self.color_ref2 = self.field2.get_synced()
+        self.points_vis2, self.color_vis2 = self.field2.points.cpu().numpy(), self.field2.colors
+        ### the raw points are of all the cameras of the new capture
+        self.points_ref2 = get_workspace_points(raw_points)
+        if conf.verbose:
+            print(f'view {view} updated: {removed} points removed from and {added} points added to the test field ({self.points2.shape[0]})')
+
+    def report_projection(self, features_full1:np.ndarray, features_full2:np.ndarray, num_probes:int=64, patch_size:int=256):
+        """compare the alignment loss landscape with the full and the projected features
+
+        A patch of the reference field is translated to random positions over the test field and the
+        L1 feature loss of every position is computed in both feature spaces.
+        """
+        rng = np.random.default_rng(self.conf.seed)
+        center = self.points1[rng.integers(self.points1.shape[0])]
+        patch = self.points1[np.argsort(np.linalg.norm(self.points1 - center, axis=-1))[:patch_size]]
+        lower, upper = self.points2.min(axis=0), self.points2.max(axis=0)
+        offsets = lower + rng.random((num_probes, 3)) * (upper - lower) - patch.mean(axis=0)
+        ### (num_probes, patch_size, 3)
+        probes = torch.from_numpy((patch[None] + offsets[:, None]).astype(np.float32))
+        losses = []
+        for features1, features2 in [(features_full1, features_full2), (self.features1, self.features2)]:
+            interpolator1 = home_made_feature_interpolator(self.points1, features1, chunk_size=4096)
+            interpolator2 = home_made_feature_interpolator(self.points2, features2, chunk_size=4096)
+            with torch.no_grad():
+                reference = interpolator1.predict(torch.from_numpy(patch[None].astype(np.float32)).to(interpolator1.dev))
+                act = interpolator2.predict(probes.to(interpolator2.dev))
+            losses.append((act - reference).abs().mean(dim=(1, 2)).cpu().numpy())
+        corr = np.corrcoef(losses[0], losses[1])[0, 1]
+        rank_full, rank_proj = np.argsort(np.argsort(losses[0])), np.argsort(np.argsort(losses[1]))
+        spearman = np.corrcoef(rank_full, rank_proj)[0, 1]
+        print('projection {} to {} dims: loss landscape pearson {:.4f}, spearman {:.4f}, best probe {} -> {}'.format(
+            self.conf.projection.method, self.proj_matrix.shape[1], corr, spearman, np.argmin(losses[0]), np.argmin(losses[1])))
+
+    def get_full_features(self, key:int)->(np.ndarray, np.ndarray):
+        """the points and the float32 features of field `key`, unaffected by field.feature_dtype
+
+        A field stored in reduced precision is built again in float32 into its own package (reused as the field),
+        and projected as the field if a projection is configured.
+
+        Returns:
+            points (n, 3), features (n, dim)
+        """
+        points, features = [self.points1, self.points2][key], [self.features1, self.features2][key]
+        if self.conf.field.feature_dtype == 'float32' or (key == 1 and self.conf.field.incremental):
+            return points, features
+        field = self.load_field(key, feature_dtype='float32')
+        features = field.get_features()
+        if self.conf.projection.method:
+            features = project_features(features, self.proj_mean, self.proj_matrix)
+        return field.points, features
+
+    def report_quantization(self, best_loss:float):
+        """compare the final best loss of the alignment with the reduced-precision features to the float32 one
+
+        The alignment is run again from the same seed with float32 interpolators of float32 fields (see get_full_features),
+        without the descriptor cache (its entries hold the reduced-precision descriptors) and without writing its results.
+
+        Args:
+            best_loss (float): the best loss of the run with the reduced-precision features
+        """
+        if self.points1 is None:
+            self.load_reference_field()
+        interpolator_conf = dict(self.interpolator_conf, feature_dtype='float32')
+        (points1, features1), (points2, features2) = self.get_full_features(0), self.get_full_features(1)
+        interpolator1 = home_made_feature_interpolator(points1, features1, **interpolator_conf)
+        interpolator2 = home_made_feature_interpolator(points2, features2, **interpolator_conf)
+        self.seed()
+        alignment = self.get_alignment(interpolator1, interpolator2, use_cache=False, visualize=False)
+        ### the outputs in ./data stay the ones of the configured run
+        alignment.sample_pts(name=self.conf.hand_ref_pose_name, save=False)
+        full_bytes = sum(features.shape[0] * features.shape[1] * 4 for features in [features1, features2])
+        ### the incremental test field is not stored
+        field_bytes = sum(field.arrays['features'].nbytes for field in [self.field1, self.field2] if hasattr(field, 'arrays'))
+        memory_bytes = full_bytes // 4 * self.interpolator2.features.element_size()
+        print('features (field {}, interpolator {}): {:.1f}MB -> {:.1f}MB stored, {:.1f}MB in memory, '
+              'best loss {:.6f} (float32 {:.6f}, delta {:+.6f})'.format(
+            self.conf.field.feature_dtype, self.conf.interpolator.feature_dtype, full_bytes / 2**20, field_bytes / 2**20,
+            memory_bytes / 2**20, best_loss, alignment.best_loss, best_loss - alignment.best_loss))
+
+    def seed(self):
+        seed = self.conf.seed
+        np.random.seed(seed)
+        random.seed(seed)
+        torch.random.manual_seed(seed)
+
+    def get_alignment(self, interpolator1, interpolator2, use_cache:bool=True, visualize:bool=None):
+        """the alignment of the mode between the reference and the test interpolators
+
+        Args:
+            use_cache (bool, optional): read and write the reference descriptors in alignment.descriptor_cache. Defaults to True.
+            visualize (bool, optional): Defaults to None(conf.visualize).
+        """
         if self.mode == 'hand':
-            alignment = Hand_AlignmentCheck(self.interpolator1, self.interpolator2, self.points1, self.points2,
-                                                self.color_ref1, self.color_ref2,
-                                                self.points_vis1, self.points_vis2,
-                                                self.color_vis1, self.color_vis2,
-                                                self.points_ref2,
-                                                trimesh_viz=self.conf.visualize, opt_iterations=self.conf.alignment.opt_iterations, 
-                                                opt_nums=self.conf.hand_model.pt_nums, tip_aug=self.conf.hand_model.tip_aug,
-                                                name=os.path.split(self.conf.data1)[-1])
+            alignment_cls, name = Hand_AlignmentCheck, os.path.split(self.conf.data1)[-1]
         elif self.mode == 'gripper':
-            alignment = Gripper_AlignmentCheck(self.interpolator1, self.interpolator2, self.points1, self.points2,
-                                                self.color_ref1, self.color_ref2,
-                                                self.points_vis1, self.points_vis2,
-                                                self.color_vis1, self.color_vis2,
-                                                self.points_ref2,
-                                                trimesh_viz=self.conf.visualize, opt_iterations=self.conf.alignment.opt_iterations, 
-                                                opt_nums=self.conf.hand_model.pt_nums, tip_aug=self.conf.hand_model.tip_aug,
-                                                name=os.path.split(self.conf.data2)[-1])
+            alignment_cls, name = Gripper_AlignmentCheck, os.path.split(self.conf.data2)[-1]
         else:
             raise NotImplementedError
+        use_cache = use_cache and self.field_hash is not None
+        return alignment_cls(interpolator1, interpolator2, self.points1, self.points2,
+                             self.color_ref1, self.color_ref2,
+                             self.points_vis1, self.points_vis2,
+                             self.color_vis1, self.color_vis2,
+                             self.points_ref2,
+                             trimesh_viz=self.conf.visualize if visualize is None else visualize,
+                             opt_iterations=self.conf.alignment.opt_iterations,
+                             opt_nums=self.conf.hand_model.pt_nums, tip_aug=self.conf.hand_model.tip_aug,
+                             name=name,
+                             num_restarts=self.conf.alignment.restarts, seeding=self.conf.alignment.seeding,
+                             descriptor_cache=self.conf.alignment.descriptor_cache if use_cache else None,
+                             field_hash=self.field_hash if use_cache else None, reference_fn=self.build_reference)
+
+    def process(self):
+        report_quantization = self.conf.verbose and (self.conf.field.feature_dtype != 'float32' or
+                                                     self.conf.interpolator.feature_dtype != 'float32')
+        if report_quantization:
+            ### the float32 run starts from the same seed
+            self.seed()
+        alignment = self.get_alignment(self.interpolator1, self.interpolator2)
         alignment.sample_pts(name=self.conf.hand_ref_pose_name)
+        if self.conf.verbose and self.conf.interpolator.mode == 'knn' and self.conf.interpolator.knn_skin:
+            print('verlet lists of the test field: ', self.interpolator2.get_verlet_stats())
+        if report_quantization:
+            self.report_quantization(alignment.best_loss)
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -5,6 +5,7 @@ import os
 import trimesh
 from typing import List
 from unified_optimize import home_made_feature_interpolator
+from prune.field import load_feature_field
 import cv2
 # from camera import  undistort
 # from camera.camera_tools import get_extrinsics_from_json, load_color_pc,\
@@ -103,10 +104,10 @@ if __name__ == '__main__':
         ### select your own ref_idx
         key = args.key
         clip = None
-        points = np.load(f'./data/points_{key}.npy')
-        features = np.load(f'./data/features_{key}.npy')
-        points_ = np.load(f'./data/points_{key + 1}.npy')
-        features_ = np.load(f'./data/features_{key + 1}.npy')
+        field = load_feature_field(f'./data/field_{key}.sdff')
+        field_ = load_feature_field(f'./data/field_{key + 1}.sdff')
+        points, features = field.points, field.get_features()
+        points_, features_ = field_.points, field_.get_features()
         if args.similarity == 'dot':
             features /= np.linalg.norm(features, axis=-1, keepdims=True)
             ref_features = features[args.ref_idx[0]]
@@ -160,11 +161,11 @@ if __name__ == '__main__':
             hand_mesh = trimesh.load_mesh(os.path.join(path, 'X_mesh.stl'))
         
         ### Load the points, colors and features
-        pts0 = np.load(os.path.join(path, f'points_0.npy'))
-        pts1 = np.load(os.path.join(path, f'points_1.npy'))
-        feat0 = np.load(os.path.join(path, f'features_0.npy'))
-        feat1 = np.load(os.path.join(path, f'features_1.npy'))
-        colors_ref = np.load(os.path.join(path, f'colors_{key}.npy')).astype(np.float32) / 255
+        field0 = load_feature_field(os.path.join(path, 'field_0.sdff'))
+        field1 = load_feature_field(os.path.join(path, 'field_1.sdff'))
+        pts0, feat0 = field0.points, field0.get_features()
+        pts1, feat1 = field1.points, field1.get_features()
+        colors_ref = [field0, field1][key].colors.astype(np.float32) / 255
 
         ### Calculate the distance in the feature field
         query_point = hand.get_surface_points()[0].cpu().numpy().mean(axis=0) # (3, )
@@ -222,11 +223,11 @@ if __name__ == '__main__':
             hand_mesh = trimesh.load_mesh(os.path.join(path, 'X_mesh.stl'))
         
         ### Load the points, colors and features
-        pts0 = np.load(os.path.join(path, f'points_0.npy'))
-        pts1 = np.load(os.path.join(path, f'points_1.npy'))
-        feat0 = np.load(os.path.join(path, f'features_0.npy'))
-        feat1 = np.load(os.path.join(path, f'features_1.npy'))
-        colors_ref = np.load(os.path.join(path, f'colors_{key}.npy')).astype(np.float32) / 255
+        field0 = load_feature_field(os.path.join(path, 'field_0.sdff'))
+        field1 = load_feature_field(os.path.join(path, 'field_1.sdff'))
+        pts0, feat0 = field0.points, field0.get_features()
+        pts1, feat1 = field1.points, field1.get_features()
+        colors_ref = [field0, field1][key].colors.astype(np.float32) / 255
         f_pca = get_pca([feat0, feat1])
         layout = go.Layout(
             scene=dict(